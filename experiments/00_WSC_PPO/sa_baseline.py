@@ -17,18 +17,11 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 
 -----------------------------------------------------------------------------"""
 
-import gym
-import sagym
 import numpy as np
-import time
-from tqdm import tqdm
-from policies import CnnPolicyOverReps, CnnLnLstmPolicyOverReps
-from stable_baselines.common.vec_env import DummyVecEnv, VecNormalize, VecCheckNan
-from stable_baselines import PPO2
 import os
 import sys
-from train import model_args, mostrecentmodification, env_generator
-from sagym.render.moviemaker import MovieMaker
+from sagym.sa import SA
+from sagym.helper import FileHamiltonianGetter, HamiltonianSuccessRecorder
 import argparse
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -49,54 +42,40 @@ experiment_description=""" """
 beta_init=float(args.tag.split('-')[-2])
 beta_end= float(args.tag.split('-')[-1])
 
-
-env = DummyVecEnv([lambda: env_generator(ep_len=episode_length, total_sweeps=episode_length*100, beta_init_function=lambda: beta_init )])
-env = VecNormalize(env, norm_obs=False, norm_reward=False, training=False)
-
-env.env_method('set_experiment_tag', indices=[0], tag=args.tag)
-env.env_method('set_max_ep_length', indices=[0], max_ep_length=episode_length)
-env.env_method("toggle_datadump_on", indices=[0])
-env.env_method('init_HamiltonianGetter', indices=[0], phase='WSC', directory=args.hamiltonian_directory )
-
-
-##This takes a while. If we don't need the policy, comment the next two lines.
-#model = PPO2(CnnLnLstmPolicyOverReps, env, verbose=True, **model_args)
-#env = model.get_env()
+SPIN_N = int(os.environ['LATTICE_L'])**2
+results_dir = os.path.join('./results', args.tag)
+os.makedirs(results_dir, exist_ok=True)
 
 num_hamiltonians = 1
 num_trials = 1000
-env.env_method("init_HamiltonianSuccessRecorder", indices=[0], num_hamiltonians=num_hamiltonians, num_trials=num_trials)
-env.env_method("set_static_Hamiltonian_by_ID", indices=[0], ID=0)
-obs = env.reset()
+HG = FileHamiltonianGetter(directory=args.hamiltonian_directory, disable_random=True, static=0)
+HSR = HamiltonianSuccessRecorder(num_hamiltonians=num_hamiltonians, num_trials=num_trials)
+HG.truncate_dataset(num_hamiltonians)
 
 
 dbeta = (beta_end - beta_init) / episode_length
-action = dbeta
 
+# The whole episode is run as one schedule, in a single backend call.  It
+# reproduces what stepping env_generator(total_sweeps=episode_length*100)
+# with a constant action of dbeta did: episode_length steps of 100 sweeps,
+# with the action divided by the env's action_scaling of 10 and spread
+# evenly over the sweeps.
+sweeps_per_step = 100
+betas = beta_init + dbeta / 10. / sweeps_per_step * np.arange(1, episode_length*sweeps_per_step + 1)
 
-test_ep=-1
+sa = SA()
 for ham in range(num_hamiltonians):
-    env.env_method("set_static_Hamiltonian_by_ID", indices=[0], ID=ham)
-    for trial in range(num_trials): 
-        test_ep += 1
-        state = None
-        done = [False for _ in range(env.num_envs)]
-        step=-1
-        while True:
-            step+=1
-
-#            action, state = model.predict(obs, state=state, mask=done, deterministic=True)
-            obs, reward, d, _ = env.step(np.array([action]))
-#            env.env_method("render", indices=[0], mode='human', destination='x')
-
-            if test_ep==1000:
-                env.env_method("toggle_datadump_off", indices=[0])
-
-            if d:
-                break
-env.env_method('close_env')
+    HG._static = ham
+    HG.get()
+    sa.load_hamiltonian(*HG.hamiltonian)
+    for trial in range(num_trials):
+        sa.reset(beta=beta_init, init='wsc', shared_init=True)
+        sa.run_schedule(betas)
+        HSR.record(result=-sa.get_all_energies() / SPIN_N, goal=-HG.ground_state, source_dir=HG._last_returned_directory)
+        HSR.print_to_screen()
+
+HSR.write(os.path.join(results_dir, 'HamiltonianSuccess.dat'))
 
 print(f"SA_RESULT: {beta_init} {beta_end} ", end='')
-env.env_method('print_hamiltonian_success_recorder_success', indices=[0])
+HSR.print_success()
 print("")
-
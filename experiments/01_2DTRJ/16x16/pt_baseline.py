@@ -0,0 +1,71 @@
+"""-----------------------------------------------------------------------------
+
+Copyright (C) 2019-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+-----------------------------------------------------------------------------"""
+
+import numpy as np
+import os
+from sagym.sa import SA, geometric_ladder
+from sagym.helper import FileHamiltonianGetter, HamiltonianSuccessRecorder
+import argparse
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-t", "--tag", help="Experiment tag (name) used for organizing output", default="pt")
+parser.add_argument("-d","--hamiltonian_directory", help="Hamiltonian directory (or packed dataset)", default="")
+parser.add_argument("-i","--beta_min", help="The smallest inverse temperature of the ladder", type=float, default=0.2)
+parser.add_argument("-e","--beta_max", help="The largest inverse temperature of the ladder", type=float, default=4.0)
+parser.add_argument("-n","--num_betas", help="The number of inverse temperatures in the ladder", type=int, default=16)
+parser.add_argument("-s","--sweeps", help="The number of sweeps per trial", type=int, default=20000)
+parser.add_argument("-x","--exchange_interval", help="The number of sweeps between exchange attempts", type=int, default=1)
+parser.add_argument("-a","--adapt", help="The number of ladder adaptations, spread over the trial", type=int, default=4)
+args = parser.parse_args()
+
+# A parallel tempering baseline, for comparison with sa_baseline.py: the 64
+# reps form 64/num_betas chains, each with the whole ladder, and the lowest
+# energy of all reps is recorded.
+SPIN_N = int(os.environ['LATTICE_L'])**2
+results_dir = os.path.join('./results', args.tag + f"i{args.beta_min}-e{args.beta_max}-n{args.num_betas}")
+os.makedirs(results_dir, exist_ok=True)
+
+num_hamiltonians = 100
+num_trials = 10
+HG = FileHamiltonianGetter(directory=args.hamiltonian_directory, disable_random=True, static=0)
+HG.truncate_dataset(num_hamiltonians)
+HSR = HamiltonianSuccessRecorder(num_hamiltonians=num_hamiltonians, num_trials=num_trials)
+
+ladder = geometric_ladder(args.beta_min, args.beta_max, args.num_betas)
+stages = args.adapt + 1
+
+sa = SA()
+for ham in range(num_hamiltonians):
+    HG._static = ham
+    HG.get()
+    sa.load_hamiltonian(*HG.hamiltonian)
+    for trial in range(num_trials):
+        sa.reset(beta=args.beta_min, init='uniform')
+        sa.set_ladder(ladder)
+        for stage in range(stages):
+            sa.run_tempering(args.sweeps // stages, args.exchange_interval)
+            if stage < args.adapt:
+                sa.adapt_ladder()
+        logging.debug(f"exchange acceptance: {np.round(sa.get_exchange_acceptance(), 2)}")
+        HSR.record(result=-sa.get_all_energies() / SPIN_N, goal=-HG.ground_state, source_dir=HG._last_returned_directory)
+        HSR.print_to_screen()
+
+HSR.write(os.path.join(results_dir, 'HamiltonianSuccess.dat'))
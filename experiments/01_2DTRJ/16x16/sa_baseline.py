@@ -17,18 +17,11 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 
 -----------------------------------------------------------------------------"""
 
-import gym
-import sagym
 import numpy as np
-import time
-from tqdm import tqdm
-from policies import CnnPolicyOverReps, CnnLnLstmPolicyOverReps
-from stable_baselines.common.vec_env import DummyVecEnv, VecNormalize, VecCheckNan
-from stable_baselines import PPO2
 import os
 import sys
-from train import model_args, mostrecentmodification, env_generator
-from sagym.render.moviemaker import MovieMaker
+from sagym.sa import SA
+from sagym.helper import FileHamiltonianGetter, HamiltonianSuccessRecorder
 import argparse
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -46,48 +39,39 @@ from train import episode_length
 experiment_name=sys.argv[1]
 experiment_description="""Reward is the negative of the minimum energy at episode termination, with no episode termination if negative beta encountered"""
 
-
-env = DummyVecEnv([lambda: env_generator(ep_len=episode_length, total_sweeps=episode_length*100, )])
-env = VecNormalize(env, norm_obs=False, norm_reward=False, training=False)
-
-env.env_method('set_experiment_tag', indices=[0], tag=args.tag + f"i{args.beta_init}-e{args.beta_end}")
-env.env_method('set_max_ep_length', indices=[0], max_ep_length=episode_length)
-env.env_method("toggle_datadump_on", indices=[0])
-env.env_method('init_HamiltonianGetter', indices=[0], phase='TEST', directory=args.hamiltonian_directory )
-
-
-model = PPO2(CnnLnLstmPolicyOverReps, env, verbose=True, **model_args)
-
-env = model.get_env()
+SPIN_N = int(os.environ['LATTICE_L'])**2
+results_dir = os.path.join('./results', args.tag + f"i{args.beta_init}-e{args.beta_end}")
+os.makedirs(results_dir, exist_ok=True)
 
 num_hamiltonians = 100
 num_trials = 10
-env.env_method("init_HamiltonianSuccessRecorder", indices=[0], num_hamiltonians=num_hamiltonians, num_trials=num_trials)
-env.env_method("set_static_Hamiltonian_by_ID", indices=[0], ID=0)
-obs = env.reset()
+HG = FileHamiltonianGetter(directory=args.hamiltonian_directory, disable_random=True, static=0)
+HG.truncate_dataset(num_hamiltonians)
+HSR = HamiltonianSuccessRecorder(num_hamiltonians=num_hamiltonians, num_trials=num_trials)
 
 
 beta_init = float(args.beta_init)
 beta_end = float(args.beta_end)
 dbeta = (beta_end - beta_init) / episode_length
 
-test_ep=-1
+# The whole episode is run as one schedule, in a single backend call.  It
+# reproduces what stepping env_generator(total_sweeps=episode_length*100)
+# with a constant action of dbeta did: reset at beta=0.3333, then
+# episode_length steps of 100 sweeps, with the action divided by the
+# env's action_scaling of 5.0 and spread evenly over the sweeps.
+beta_reset = 0.3333
+sweeps_per_step = 100
+betas = beta_reset + dbeta / 5.0 / sweeps_per_step * np.arange(1, episode_length*sweeps_per_step + 1)
+
+sa = SA()
 for ham in range(num_hamiltonians):
-    env.env_method("set_static_Hamiltonian_by_ID", indices=[0], ID=ham)
-    for trial in range(num_trials): 
-        test_ep += 1
-        state = None
-        done = [False for _ in range(env.num_envs)]
-        step=-1
-        while True:
-            step+=1
-
-#            action, state = model.predict(obs, state=state, mask=done, deterministic=True)
-            obs, reward, d, _ = env.step(np.array([dbeta]))
-
-            if test_ep==1000:
-                env.env_method("toggle_datadump_off", indices=[0])
-
-            if d:
-                break
-env.env_method('close_env')
+    HG._static = ham
+    HG.get()
+    sa.load_hamiltonian(*HG.hamiltonian)
+    for trial in range(num_trials):
+        sa.reset(beta=beta_reset, init='bernoulli', shared_init=True)
+        sa.run_schedule(betas)
+        HSR.record(result=-sa.get_all_energies() / SPIN_N, goal=-HG.ground_state, source_dir=HG._last_returned_directory)
+        HSR.print_to_screen()
+
+HSR.write(os.path.join(results_dir, 'HamiltonianSuccess.dat'))
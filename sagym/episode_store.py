@@ -0,0 +1,192 @@
+"""-----------------------------------------------------------------------------
+
+Copyright (C) 2019-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+-----------------------------------------------------------------------------"""
+
+import atexit
+import queue
+import threading
+import h5py
+import numpy as np
+
+# Fields with one row per step of an episode, concatenated over episodes
+STEP_FIELDS = ('states', 'Tdat', 'Mdat', 'Edat', 'Adat', 'arat')
+
+
+class EpisodeWriter(object):
+    """Appends episodes to a single chunked, compressed HDF5 file.
+
+       Every per-step field (see STEP_FIELDS) is one resizable dataset, with
+       the steps of all episodes concatenated; every other field is one
+       resizable dataset with a row per episode.  The 'index' dataset holds
+       the [first step, number of steps] of every episode, and 'episode'
+       the episode numbers.  Episodes need not all have the same fields
+       (the telemetry level may change between them), so the datasets do
+       not grow in step: 'rows/<field>' holds the first row of every
+       episode in dataset <field>, or -1 where the episode lacks it.
+
+       Episodes are written by a background thread, so write() only
+       enqueues them.  The queue is bounded: if the disk cannot keep up,
+       write() blocks rather than letting episodes pile up in memory.  If
+       writing fails, the store stops, and write(), flush() and close()
+       raise the error.
+
+       Args:
+           path (str): The HDF5 file, appended to if it exists
+           max_queue (int): The number of episodes that may be waiting
+           compression (str): The h5py compression filter
+    """
+    def __init__(self, path, max_queue=16, compression='lzf'):
+        self.path = path
+        self.compression = compression
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._file = h5py.File(path, 'a')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, episode, fields):
+        """
+        Queue an episode for writing.
+
+        Args:
+            episode (int): The episode number
+            fields (dict): Arrays by name.  They are copied, so the caller
+                may reuse its buffers at once.
+        """
+        self._raise_error()
+        if self._thread is None:
+            raise RuntimeError("the episode store is closed")
+        fields = {name: np.array(value) for name, value in fields.items()}
+        self._queue.put((episode, fields))
+
+    def flush(self):
+        """Block until every queued episode is on disk"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write the queued episodes and close the file"""
+        if self._thread is None:
+            return
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        with self._file as F:
+            while True:
+                item = self._queue.get()
+                try:
+                    if item is None:
+                        return
+                    if self._error is None:
+                        self._append(F, *item)
+                        F.flush()
+                except Exception as e:
+                    self._error = e
+                finally:
+                    self._queue.task_done()
+
+    def _append(self, F, episode, fields):
+        count = len(F['index']) if 'index' in F else 0
+        start = F['index'][-1].sum() if count else 0
+        length = 0
+        for name in STEP_FIELDS:
+            if name in fields:
+                length = max(length, len(fields[name]))
+
+        for name, value in fields.items():
+            first = F[name].shape[0] if name in F else 0
+            if name in STEP_FIELDS:
+                self._extend(F, name, value)
+            else:
+                self._extend(F, name, value[np.newaxis])
+            # Earlier episodes without this field get -1
+            key = 'rows/' + name
+            missing = count - (F[key].shape[0] if key in F else 0)
+            self._extend(F, key, np.array([-1] * missing + [first], dtype=np.int64))
+        # The index goes last, so an episode only counts once it is whole
+        self._extend(F, 'index', np.array([[start, length]], dtype=np.int64))
+        self._extend(F, 'episode', np.array([episode], dtype=np.int64))
+
+    def _extend(self, F, name, rows):
+        if name not in F:
+            # Chunks of about 1 MB, whole rows each
+            row_bytes = rows.dtype.itemsize * int(np.prod(rows.shape[1:]))
+            chunk_rows = int(min(4096, max(1, (1 << 20) // row_bytes)))
+            F.create_dataset(name, data=rows, maxshape=(None,) + rows.shape[1:],
+                             chunks=(chunk_rows,) + rows.shape[1:],
+                             compression=self.compression)
+            return
+        dataset = F[name]
+        n = dataset.shape[0]
+        dataset.resize(n + rows.shape[0], axis=0)
+        dataset[n:] = rows
+
+
+class EpisodeReader(object):
+    """Reads episodes back from a file written by EpisodeWriter.
+
+       Only the index and the rows of every field are loaded up front.
+       Indexing returns one episode as a dict of arrays, read by slicing
+       the datasets, so that only the chunks of that episode are read and
+       decompressed; fields the episode was written without are left out.
+       Datasets may also be sliced directly through the h5py file,
+       reader.file.
+    """
+    def __init__(self, path):
+        self.file = h5py.File(path, 'r')
+        self.index = self.file['index'][:] if 'index' in self.file else np.zeros((0, 2), dtype=np.int64)
+        self.episodes = self.file['episode'][:] if 'episode' in self.file else np.zeros(0, dtype=np.int64)
+        self.rows = {}
+        if 'rows' in self.file:
+            self.rows = {name: rows[:] for name, rows in self.file['rows'].items()}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        length = self.index[i][1]
+        episode = {}
+        for name, rows in self.rows.items():
+            if i >= len(rows) or rows[i] < 0:
+                continue
+            first = rows[i]
+            if name in STEP_FIELDS:
+                episode[name] = self.file[name][first:first + length]
+            else:
+                episode[name] = self.file[name][first]
+        episode['episode'] = self.episodes[i]
+        return episode
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
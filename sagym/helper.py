@@ -20,50 +20,10 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import math
 import os
-import shutil
 import logging
 import time
-
-
-def generate_latinit_bernoulli(lines):
-    """Uniformly distributed number of up/down spins"""
-    num_up = np.random.randint(0,lines)
-    spins = np.array([1]*num_up + [-1]*(lines-num_up)).astype(np.int)
-    np.random.shuffle(spins)
-
-
-    with open("./latinit", "w") as F:
-        for i in range(lines):
-            pass
-            F.write(f"{spins[i]}\n")
-
-def generate_WSC_latinit(lines):
-    spins = [-1]*8 + [1.0]*8
-
-    with open("./latinit", "w") as F:
-        for i in range(lines):
-            F.write(f"{spins[i]}\n")
-
-def generate_latinit_random(lines):
-    """Each spin randomly drawn with 50% up/down probability"""
-    #num_up = np.random.randint(0,lines)
-    #spins = [1.0]*num_up + [-1.0]*(lines-num_up)
-    spins = 2*np.random.randint(0,2,lines)-1
-    #np.random.shuffle(spins)
-
-    with open("./latinit", "w") as F:
-        for i in range(lines):
-            F.write(f"{spins[i]}\n")
-
-def generate_latinit(lines):
-    generate_latinit_bernoulli(lines)
-
-
-
-
-
-
-
+import queue
+import threading
 
 
 def evaluate_success(result, goal):
@@ -120,14 +80,68 @@ class HamiltonianSuccessRecorder(object):
         print(np.nanmean(self.all_results)*100)
 
 
-#from sagym.models import make_rndj_nn_sg as make_latfile
-from sagym.models import make_rndj_notrunc_nn_sg as make_latfile
+def read_latfile(latfile):
+    """Parse a latfile into (rows, cols, couplings) arrays, suitable
+       for SA.load_hamiltonian"""
+    data = np.loadtxt(latfile, skiprows=1, ndmin=2)
+    rows = data[:, 0].astype(np.intc)
+    cols = data[:, 1].astype(np.intc)
+    return rows, cols, data[:, 2].copy()
+
+
+from sagym.models import toroidal_links
 class RandomHamiltonianGetter(object):
-    def __init__(self, L):
+    """Draws random L x L toroidal nearest-neighbour instances (see
+       models.toroidal_couplings for the kinds of couplings).
+
+       With prefetch > 0, a background thread keeps the next prefetch
+       instances ready, so that get() only takes one off a queue; close()
+       stops it.  The instances are drawn from a RandomState of their own,
+       seeded with seed, if prefetching or if a seed is given; otherwise
+       from np.random.
+    """
+    def __init__(self, L, kind='gaussian', prefetch=0, seed=None):
         self.L = L
-    
+        self.kind = kind
+        self.hamiltonian = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._rng = None
+        if prefetch > 0 or seed is not None:
+            self._rng = np.random.RandomState(seed)
+        if prefetch > 0:
+            self._queue = queue.Queue(maxsize=prefetch)
+            self._thread = threading.Thread(target=self._prefetch, daemon=True)
+            self._thread.start()
+
+    def _prefetch(self):
+        while not self._stop.is_set():
+            links = toroidal_links(self.L, kind=self.kind, rng=self._rng)
+            # Wait for room in the queue, but not past close()
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(links, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
     def get(self):
-        make_latfile('./latfile', L=self.L)
+        """Draw a new instance; its links are left in self.hamiltonian"""
+        # After close(), the prefetched instances are used up first
+        if self._thread is not None or self._queue is not None and not self._queue.empty():
+            self.hamiltonian = self._queue.get()
+        else:
+            self.hamiltonian = toroidal_links(self.L, kind=self.kind, rng=self._rng)
+
+    def close(self):
+        """Stop the prefetch thread.  Instances already prefetched are
+           still served, and later ones are drawn by get() itself."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
     
     @property
     def ground_state(self):
@@ -142,13 +156,24 @@ class RandomHamiltonianGetter(object):
         pass
 
 class FileHamiltonianGetter(object):
+    """Serves Hamiltonians from a dataset directory, with one subdirectory
+       (latfile, gs_energy) per instance, or from a dataset packed into a
+       single file by sagym.packed, which is memory-mapped instead."""
     def __init__(self, directory, disable_random, static=None):
         self._disable_random=disable_random
         self._last_idx = 0
         self._directory = directory
-        self._list_dir = sorted(os.listdir(self._directory))
+        self._packed = None
+        if os.path.isfile(directory):
+            from sagym.packed import PackedHamiltonians
+            self._packed = PackedHamiltonians(directory)
+            self._list_dir = list(self._packed.names)
+        else:
+            self._list_dir = sorted(os.listdir(self._directory))
         self._last_returned_directory = None
         self._static = static
+        self._hamiltonians = dict()
+        self.hamiltonian = None
         print(f"{len(self._list_dir)} directories found")
 
     @property
@@ -172,7 +197,14 @@ class FileHamiltonianGetter(object):
             dirr = self._list_dir[self._static % len(self._list_dir)]
 
         self._last_returned_directory = os.path.join(self._directory, dirr)
-        shutil.copyfile(self._last_returned_directory + '/latfile', "./latfile")
+        if self._packed is not None:
+            return self._get_packed(dirr)
+        # Parsed instances are cached, so that a repeated instance is the
+        # very same object and need not be reloaded by the annealer.
+        if self._last_returned_directory not in self._hamiltonians:
+            self._hamiltonians[self._last_returned_directory] = read_latfile(
+                os.path.join(self._last_returned_directory, 'latfile'))
+        self.hamiltonian = self._hamiltonians[self._last_returned_directory]
         try:
             self._last_returned_gs_energy = float(open(self._directory + dirr + "/gs_energy", 'r').read())
         except:
@@ -181,6 +213,19 @@ class FileHamiltonianGetter(object):
 
         return self._last_returned_gs_energy
 
+    def _get_packed(self, name):
+        idx = self._packed.index(name)
+        # The instance arrays are views of the memory map; they are cached
+        # only so that a repeated instance is the same object.
+        if idx not in self._hamiltonians:
+            self._hamiltonians[idx] = self._packed[idx]
+        self.hamiltonian = self._hamiltonians[idx]
+        self._last_returned_gs_energy = float(self._packed.gs_energy[idx])
+        if math.isnan(self._last_returned_gs_energy):
+            logging.error(f"No ground state energy was packed for {self._last_returned_directory}.  Please make sure the reference energy is present.")
+            raise Exception
+        return self._last_returned_gs_energy
+
     def report_energy(self, energy):
         return
 #        if (energy-self._last_returned_gs_energy) < -1e-6:
@@ -34,14 +34,17 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #include <cmath>
 #include <vector>
 #include <string>
-#include <boost/random/shuffle_order.hpp>
-#include <boost/random/mersenne_twister.hpp>
+#include <memory>
+#include <cstdint>
 
 #include <string>
 #include <sstream>
 #include <iostream>
 #include <fstream>
 #include <ctime>
+#include <stdexcept>
+#include <utility>
+#include <algorithm>
 
 #include "site.h"
 #include "lattice.h"
@@ -53,6 +56,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 
+/**
+ * A single replica.  The read-only coupling graph is shared between all
+ * replicas of a Hamiltonian; a replica only owns its dense spin and
+ * local field (de) arrays.
+ */
 class Algorithm {
 
 public:
@@ -63,30 +71,45 @@ public:
   int accepts=0;
   int totals=0;
 
-
-  Algorithm(const Lattice& lattice)
+  /**
+   * Accepted Wolff cluster moves, and the spins they flipped
+   */
+  unsigned long cluster_moves=0;
+  unsigned long cluster_spins=0;
+
+  /**
+   * The acceptance ratio of the last sweep, and the number of sweeps
+   * made by the rejection-free kernel
+   */
+  double last_acceptance=1;
+  unsigned long rejection_free_sweeps=0;
+
+  /**
+   * Whether sweeps on a torus (see Lattice::torus_size) go through the
+   * torus stencil rather than the generic coupling graph.  The Metropolis
+   * sweep is bit-identical either way; the rejection-free sweep visits
+   * the neighbours in a different order, and so samples the same process
+   * along a different trajectory.
+   */
+  bool use_stencil=true;
+
+
+  Algorithm(std::shared_ptr<const Lattice> lattice) :
+    lattice(lattice),
+    spin(lattice->num_sites(), 1),
+    de(lattice->num_sites(), 0.0)
   {
-     lattice.init_sites(sites);
   }
 
 
   void set_negative() {
-    for(auto& site : sites)
-      site.spin = -1;
-    for(auto& site : sites) {
-      double tmp = site.local_field_bias;
-      for(size_t k = 0; k < site.nneighbs; ++k) {
-        tmp -= site.neighbors[k].coupler;
-      }
-      site.de = -tmp * site.spin;
-    }
+    for (auto& s : spin)
+      s = -1;
+    update_local_fields();
   }
 
 
-  
-
-
-  void reset_sites(size_t rep) {
+  void seed(size_t rep) {
 
     struct timespec ts;
     clock_gettime(CLOCK_MONOTONIC, &ts);
@@ -94,50 +117,145 @@ public:
 
 //_random.seed((rep+1) * time( NULL ) );
 
-    ifstream File;
-    File.open("latinit");
-    int tmp;
-    int i;
-    for(auto& site : sites)
-    {
-       File >> tmp; //tmp = File.getline(); 
-       if (tmp==1) {
-//           cout << "Read spin 1 from file " << endl; 
-           site.spin = 1;
-       } else if (tmp==-1) {
-//           cout << "Read spin -1 from file " << endl; 
-           site.spin = -1;
-       } else {
-        site.spin = _random.next_bool() ? 1 : -1;
-       }
-    }
-    File.close();
-  
+  }
+
+  /**
+   * Seed replica rep deterministically from a user seed.  Every replica
+   * gets its own stream, derived from (seed, rep) alone, so results do not
+   * depend on how replicas are spread over threads.
+   */
+  void seed(uint64_t value, size_t rep) {
+    uint64_t stream = mix64(mix64(value) ^ mix64(uint64_t(rep) + 1));
+    _random.seed(stream);
+  }
+
 
-    for(auto& site : sites) {
+  /**
+   * Set the spins from an array of num_sites() values.  Entries that are
+   * neither 1 nor -1 are drawn at random.
+   */
+  void set_spins(const int* spins) {
 
-      double tmp = site.local_field_bias;
-      for(size_t k = 0; k < site.nneighbs; ++k) {
-        tmp += site.neighbors[k].coupler * sites[site.neighbors[k].id].spin;
+    for (size_t i = 0; i < spin.size(); ++i) {
+      if (spins[i] == 1) {
+        spin[i] = 1;
+      } else if (spins[i] == -1) {
+        spin[i] = -1;
+      } else {
+        spin[i] = _random.next_spin();
       }
-      site.de = -tmp * site.spin;
+    }
+
+    update_local_fields();
+
+  }
+
 
+  /**
+   * Draw the spins from one of the initial state generators:
+   *   "uniform"   : every spin is up or down with probability 1/2,
+   *   "bernoulli" : the number of up spins is uniform in [0, N), and the
+   *                 up spins are placed at random,
+   *   "wsc"       : the first half of the spins down, the rest up.
+   */
+  void init_spins(const std::string& kind) {
+
+    const size_t n = spin.size();
+
+    if (kind == "uniform") {
+      for (auto& s : spin) {
+        s = _random.next_spin();
+      }
+    } else if (kind == "bernoulli") {
+      size_t num_up = _random.next_uniform_integer(0, n - 1);
+      for (size_t i = 0; i < n; ++i) {
+        spin[i] = i < num_up ? 1 : -1;
+      }
+      for (size_t i = n - 1; i > 0; --i) {
+        std::swap(spin[i], spin[_random.next_uniform_integer(0, i)]);
+      }
+    } else if (kind == "wsc") {
+      for (size_t i = 0; i < n; ++i) {
+        spin[i] = i < n / 2 ? -1 : 1;
+      }
+    } else {
+      throw std::invalid_argument("unknown initial state '" + kind + "'");
     }
 
+    update_local_fields();
+
   }
 
-  void flip_spin(site_type& site) {
 
-    site.spin = -site.spin;
-    site.de = -site.de;
+  /**
+   * Recompute the local fields, energy and magnetization from scratch.
+   * They are then tracked incrementally by flip_spin.
+   */
+  void update_local_fields() {
+
+    const uint32_t* offsets = lattice->offsets();
+    const uint32_t* neighbors = lattice->neighbors();
+    const double* couplers = lattice->couplers();
+    const double* biases = lattice->biases();
+
+    energy = 0;
+    magnetization = 0;
+    ++flips;
+
+    for (size_t i = 0; i < spin.size(); ++i) {
+
+      double tmp = biases[i];
+      double pair = 0;
+      for (uint32_t k = offsets[i]; k < offsets[i + 1]; ++k) {
+        pair += couplers[k] * spin[neighbors[k]];
+      }
+      tmp += pair;
+      de[i] = -tmp * spin[i];
+
+      energy += (biases[i] + pair / 2) * spin[i];
+      magnetization += spin[i];
 
-    for (size_t k = 0; k<site.nneighbs; ++k) {
-      site_type& neighbor = sites[site.neighbors[k].id];
-      neighbor.de -= 2 * neighbor.spin * site.neighbors[k].coupler * site.spin;
     }
 
   }
 
+  void flip_spin(size_t i) {
+    flip_spin(i, GraphStencil(*lattice));
+  }
+
+  template <typename Stencil>
+  void flip_spin(size_t i, const Stencil& stencil) {
+
+    // flipping spin i changes the energy by twice its local field term
+    energy += 2 * de[i];
+    ++flips;
+
+    spin[i] = -spin[i];
+    de[i] = -de[i];
+    magnetization += 2 * spin[i];
+
+    const double s2 = 2 * spin[i];
+    stencil.for_each_neighbor(i, [&](uint32_t j, double coupling) {
+      de[j] -= s2 * spin[j] * coupling;
+    });
+
+  }
+
+
+  /**
+   * Take over the configuration of another replica of the same
+   * Hamiltonian: spins, local fields, energy, magnetization and beta.
+   * The random stream and the acceptance counters are kept.
+   */
+  void copy_state(const Algorithm& other) {
+    spin = other.spin;
+    de = other.de;
+    energy = other.energy;
+    magnetization = other.magnetization;
+    beta = other.beta;
+    ++flips;
+  }
+
 
   void reset_acceptance() {
     accepts=0;
@@ -145,25 +263,216 @@ public:
   }
 
 
+  /**
+   * One Metropolis sweep: num_sites() proposals at random sites.  The
+   * random numbers for the whole sweep are drawn in one block.  A flip is
+   * accepted when x = 2*beta*de < -log(U); since
+   * 1-U <= -log(U) <= (1-U)/U, the log is only evaluated when x falls
+   * between those two bounds.
+   */
   void do_sweep(size_t sweep) {
+    with_stencil(*lattice, use_stencil, MetropolisSweep{*this});
+  }
+
+  /**
+   * The rejection-free counterpart of do_sweep; see
+   * rejection_free_sweep.  Requires beta > 0.
+   */
+  void do_sweep_rejection_free(size_t sweep) {
+    with_stencil(*lattice, use_stencil, RejectionFreeSweep{*this});
+  }
+
+  template <typename Stencil>
+  void metropolis_sweep(const Stencil& stencil) {
 
-    for (size_t i = 0; i < sites.size(); ++i) {
-      size_t next_index= _random.next_uniform_integer(0, sites.size() - 1);
-      //cout << "beta=" << *beta << endl;
-      if (sites[next_index].de <
-        -log(_random.next_uniform_real(0,1)) / (beta * 2)) {
-        flip_spin(sites[next_index]);
-	accepts++;
-      } 
+    const size_t n = spin.size();
+    const double two_beta = 2 * beta;
+    const int accepted = accepts;
+
+    block.resize(2 * n);
+    _random.fill(block.data(), block.size());
+
+    for (size_t i = 0; i < n; ++i) {
+      const size_t next_index = _random.next_index(block[2 * i], uint32_t(n));
+      const double u = _random.unit_real(block[2 * i + 1]);
+      const double x = two_beta * de[next_index];
+
+      bool accept;
+      if (two_beta <= 0) {
+        accept = de[next_index] < -log(u) / two_beta;
+      } else if (x <= 1 - u) {
+        accept = true;
+      } else if (x * u >= 1 - u) {
+        accept = false;
+      } else {
+        accept = x < -log(u);
+      }
+
+      if (accept) {
+        flip_spin(next_index, stencil);
+        accepts++;
+      }
       totals++;
     }
 
+    last_acceptance = double(accepts - accepted) / n;
+
   }
 
-  string get_configuration() {
+
+  /**
+   * A sweep equivalent in distribution to do_sweep, for low acceptance:
+   * the n-fold way (Bortz, Kalos and Lebowitz) with thinning.  The sites
+   * are kept in bins of de, each with an upper bound on the acceptance
+   * exp(-2*beta*de) of its sites.  Since a proposal picks a site at
+   * random, the number of proposals up to the next one that passes its
+   * bin's bound is geometric, and is skipped in one draw; that site is
+   * then drawn with probability proportional to its bound and accepted
+   * with probability acceptance/bound.  The sweep ends after num_sites()
+   * proposals, as do_sweep does, but its cost is in proportion to the
+   * proposals that pass the bounds rather than to all proposals.
+   */
+  template <typename Stencil>
+  void rejection_free_sweep(const Stencil& stencil) {
+
+    const size_t n = spin.size();
+    const double two_beta = 2 * beta;
+
+    if (binned_flips != flips || bin_sites.empty()) {
+      build_bins();
+    }
+
+    // The bound of bin k > 0 is the acceptance at its lower edge
+    if (beta != rated_beta) {
+      const double ratio = std::exp(-two_beta * bin_width);
+      bin_rate[1] = 1;
+      for (size_t k = 2; k < NUM_BINS; ++k) {
+        bin_rate[k] = bin_rate[k - 1] * ratio;
+      }
+      rated_beta = beta;
+    }
+    double total = 0;
+    for (size_t k = 0; k < NUM_BINS; ++k) {
+      total += bin_rate[k] * bin_sites[k].size();
+    }
+
+    double remaining = n;
+    int accepted = 0;
+    while (total > 0) {
+      // proposals up to and including the next one that passes its bound
+      const double q = total / n;
+      double skip = 1;
+      if (q < 1) {
+        skip += std::floor(std::log(_random.next_unit_real()) / std::log1p(-q));
+      }
+      if (skip > remaining) {
+        break;
+      }
+      remaining -= skip;
+
+      double target = _random.next_unit_real() * total;
+      size_t k = 0;
+      while (k + 1 < NUM_BINS && target >= bin_rate[k] * bin_sites[k].size()) {
+        target -= bin_rate[k] * bin_sites[k].size();
+        ++k;
+      }
+      if (bin_sites[k].empty()) {
+        continue;
+      }
+      const uint32_t i = bin_sites[k][_random.next_index(uint32_t(bin_sites[k].size()))];
+
+      const double acceptance = de[i] <= 0 ? 1 : std::exp(-two_beta * de[i]);
+      if (acceptance >= bin_rate[k] || _random.next_unit_real() * bin_rate[k] < acceptance) {
+        flip_spin(i, stencil);
+        total += rebin(i);
+        stencil.for_each_neighbor(i, [&](uint32_t j, double) {
+          total += rebin(j);
+        });
+        accepted++;
+      }
+    }
+
+    binned_flips = flips;
+    accepts += accepted;
+    totals += n;
+    last_acceptance = double(accepted) / n;
+    rejection_free_sweeps++;
+
+  }
+
+  /**
+   * One Wolff cluster move.  A cluster is grown from a random site over
+   * the satisfied bonds (J*s_i*s_j < 0), each taken with probability
+   * 1-exp(-2*beta*|J|), and flipped with probability
+   * min(1, exp(-beta*dE)), where dE is the change of the field energy;
+   * without fields, every cluster is flipped.  Valid for any couplings,
+   * but only efficient for ferromagnetic ones: in a spin glass the
+   * clusters percolate at low temperature.
+   */
+  void wolff_update() {
+
+    const uint32_t* offsets = lattice->offsets();
+    const uint32_t* neighbors = lattice->neighbors();
+    const double* couplers = lattice->couplers();
+    const double* biases = lattice->biases();
+    const size_t n = spin.size();
+
+    if (mark.size() != n) {
+      mark.assign(n, 0);
+      stamp = 0;
+    }
+    if (++stamp == 0) {
+      std::fill(mark.begin(), mark.end(), 0);
+      stamp = 1;
+    }
+
+    const uint32_t start = _random.next_index(uint32_t(n));
+    cluster.clear();
+    cluster.push_back(start);
+    mark[start] = stamp;
+
+    double field = 0;
+    for (size_t c = 0; c < cluster.size(); ++c) {
+      const uint32_t i = cluster[c];
+      field += biases[i] * spin[i];
+      for (uint32_t k = offsets[i]; k < offsets[i + 1]; ++k) {
+        const uint32_t j = neighbors[k];
+        const double bond = couplers[k] * spin[i] * spin[j];
+        if (mark[j] != stamp && bond < 0
+          && _random.next_unit_real() < -std::expm1(2 * beta * bond)) {
+          mark[j] = stamp;
+          cluster.push_back(j);
+        }
+      }
+    }
+
+    const double dE = -2 * field;
+    if (dE <= 0 || _random.next_unit_real() < std::exp(-beta * dE)) {
+      for (const uint32_t i : cluster) {
+        flip_spin(i);
+      }
+      cluster_moves++;
+      cluster_spins += cluster.size();
+    }
+
+  }
+
+  /**
+   * Make rate Wolff moves per call on average: whole moves are made as
+   * the fractional rates add up.
+   */
+  void wolff_updates(double rate) {
+    wolff_credit += rate;
+    while (wolff_credit >= 1) {
+      wolff_update();
+      wolff_credit -= 1;
+    }
+  }
+
+  string get_configuration() const {
     string configuration;
-    for (size_t i=0; i<sites.size(); ++i) {
-      if (sites[i].spin>0) {
+    for (size_t i=0; i<spin.size(); ++i) {
+      if (spin[i]>0) {
         configuration+="+";
       } else {
         configuration+="-";
@@ -173,64 +482,172 @@ public:
   }
 
 
-  int get_site(int n) {
-    return sites[n].spin;
+  int get_site(int n) const {
+    return spin[n];
   }
 
-  int num_sites() {
-    return sites.size();
+  template <typename spin_type>
+  void get_spins(spin_type* spins) const {
+    for (size_t i = 0; i < spin.size(); ++i) {
+      spins[i] = spin[i];
+    }
   }
 
+  int num_sites() const {
+    return spin.size();
+  }
 
-  float get_energy() const {
-
-    double energy = 0;
-    for(const auto& site : sites) {
-
-      double tmp = site.local_field_bias;
-
-      for(size_t k = 0; k < site.nneighbs; ++k) {
-        tmp += sites[site.neighbors[k].id].spin * site.neighbors[k].coupler / 2;
-      }
-      energy += tmp * site.spin;
-    }
 
+  /**
+   * The energy of the current configuration, tracked in O(1) per flip.
+   */
+  double get_energy() const {
     return energy;
   }
 
+  /**
+   * The sum of the spins, tracked in O(1) per flip.
+   */
+  long get_magnetization() const {
+    return magnetization;
+  }
+
   void get_energies(vector<pair<double, string> >& en, size_t index) const {
+    en[index].first = get_energy();
+    en[index].second = get_configuration();
+  }
 
-    string configuration;
-    double energy = 0;
-    for(const auto& site : sites) {
+private:
 
-      if (site.spin>=0) {
-        configuration+="+";
-      } else {
-        configuration+="-";
-      }
-      double tmp = site.local_field_bias;
+  /**
+   * The sweep kernels, as functors taking the stencil
+   */
+  struct MetropolisSweep {
+    Algorithm& a;
+    template <typename Stencil>
+    void operator()(const Stencil& stencil) const {
+      a.metropolis_sweep(stencil);
+    }
+  };
 
-      for(size_t k = 0; k < site.nneighbs; ++k) {
-        tmp += sites[site.neighbors[k].id].spin * site.neighbors[k].coupler / 2;
-      }
+  struct RejectionFreeSweep {
+    Algorithm& a;
+    template <typename Stencil>
+    void operator()(const Stencil& stencil) const {
+      a.rejection_free_sweep(stencil);
+    }
+  };
+
+  /**
+   * Sort every site into its bin of de: bin 0 holds de <= 0, and bin
+   * k > 0 holds de in [(k-1)*bin_width, k*bin_width), the last one
+   * everything above.
+   */
+  void build_bins() {
+    const size_t n = spin.size();
+    bin_width = std::max(lattice->max_local_field(), 1e-300) / (NUM_BINS - 1);
+    bin_sites.assign(NUM_BINS, std::vector<uint32_t>());
+    bin_rate.assign(NUM_BINS, 1.0);
+    rated_beta = std::nan("");
+    site_bin.resize(n);
+    site_slot.resize(n);
+    for (uint32_t i = 0; i < n; ++i) {
+      const size_t k = bin_of(de[i]);
+      site_bin[i] = k;
+      site_slot[i] = bin_sites[k].size();
+      bin_sites[k].push_back(i);
+    }
+  }
 
-      energy += tmp * site.spin;
+  size_t bin_of(double value) const {
+    if (value <= 0) {
+      return 0;
     }
+    return std::min<size_t>(NUM_BINS - 1, 1 + size_t(value / bin_width));
+  }
 
-    en[index].first = energy;
-    en[index].second= configuration;
+  /**
+   * Move site i to the bin of its current de, and return the change in
+   * the total bound.
+   */
+  double rebin(uint32_t i) {
+    const size_t from = site_bin[i];
+    const size_t to = bin_of(de[i]);
+    if (from == to) {
+      return 0;
+    }
+    std::vector<uint32_t>& sites = bin_sites[from];
+    const uint32_t last = sites.back();
+    sites[site_slot[i]] = last;
+    site_slot[last] = site_slot[i];
+    sites.pop_back();
+
+    site_bin[i] = to;
+    site_slot[i] = bin_sites[to].size();
+    bin_sites[to].push_back(i);
+    return bin_rate[to] - bin_rate[from];
+  }
 
+  /**
+   * The splitmix64 finalizer, a bijective 64-bit mixing function.
+   */
+  static uint64_t mix64(uint64_t z) {
+    z += 0x9e3779b97f4a7c15ULL;
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
   }
 
-private:
+  std::shared_ptr<const Lattice> lattice;
+
+  std::vector<int8_t> spin;
+
+  std::vector<double> de;
+
+  double energy = 0;
+
+  long magnetization = 0;
+
+  random_number_generator<xoshiro256ss> _random;
+
+  /**
+   * Raw random numbers of the current sweep, two per proposal.
+   */
+  std::vector<uint64_t> block;
+
+  /**
+   * Scratch space of the Wolff moves: the sites of the cluster, and the
+   * sites marked with the current stamp are in it.
+   */
+  std::vector<uint32_t> cluster;
+
+  std::vector<uint32_t> mark;
+
+  uint32_t stamp = 0;
+
+  double wolff_credit = 0;
+
+  /**
+   * The bins of the rejection-free kernel.  They are valid while no spin
+   * has been flipped outside of it, i.e. while binned_flips == flips.
+   */
+  static const size_t NUM_BINS = 128;
+
+  std::vector<std::vector<uint32_t> > bin_sites;
+
+  std::vector<double> bin_rate;
+
+  std::vector<uint8_t> site_bin;
+
+  std::vector<uint32_t> site_slot;
+
+  double bin_width = 0;
 
-  std::vector<site_type> sites;
+  double rated_beta = 0;
 
-  std::vector<double> beta_schedule;
+  unsigned long flips = 0;
 
-  //random_number_generator<boost::random::knuth_b> _random;
-  random_number_generator<boost::random::mt19937> _random;
+  unsigned long binned_flips = 0;
 
 };
 
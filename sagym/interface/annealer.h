@@ -0,0 +1,1204 @@
+/******************************************************************************
+
+Simulated Annealing
+
+Copyright (C) 2017-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This code is a modification of the 2012-2013 code of Sergei Isakov (Google).
+The rights and license is hence inherited from the original as GNU General
+Public License (v3). Original license follows.
+
+---------------------------------------------------------------------
+
+Copyright (C) 2012-2013 by Sergei Isakov <isakov@itp.phys.ethz.ch>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+*******************************************************************************/
+
+#ifndef __ANNEALER_H__
+#define __ANNEALER_H__
+
+#include <cmath>
+#include <string>
+#include <vector>
+#include <iostream>
+#include <memory>
+#include <stdexcept>
+#include <exception>
+#include <thread>
+#include <mutex>
+#include <atomic>
+#include <algorithm>
+#include <utility>
+#include <ctime>
+
+#include "lattice.h"
+#include "alg.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+
+/**
+ * A self-contained simulated annealing engine: an ensemble of replicas
+ * annealed side by side.  The replicas are split into num_groups()
+ * contiguous groups of equal size, and every group may be given its own
+ * Hamiltonian (all with the same number of spins), so that one run()
+ * anneals several instances at once.  With a single group, the engine
+ * anneals one Hamiltonian.
+ *
+ * All state that used to live in file-scope globals of sa.cc is held here,
+ * so a single process may own any number of independent engines.
+ */
+class Annealer {
+
+public:
+
+  /**
+   * An engine with nreps replicas in ngroups groups, annealed by up to
+   * nthreads OpenMP threads.  nthreads=0 uses the OpenMP default
+   * (OMP_NUM_THREADS).
+   */
+  Annealer(unsigned nreps=64, unsigned nthreads=0, unsigned ngroups=1) :
+    nreps(nreps), lattices(ngroups) {
+
+    if (nreps == 0) {
+      throw std::invalid_argument("an annealer needs at least one replica");
+    }
+    if (ngroups == 0 || nreps % ngroups != 0) {
+      throw std::invalid_argument("the number of replicas must be a "
+        "positive multiple of the number of groups");
+    }
+
+#ifdef _OPENMP
+    n_threads = nthreads ? nthreads : omp_get_max_threads();
+#else
+    n_threads = 1;
+#endif
+
+  }
+
+  ~Annealer() {
+    if (worker.joinable()) {
+      worker.join();
+    }
+  }
+
+  Annealer(const Annealer&) = delete;
+  Annealer& operator=(const Annealer&) = delete;
+
+
+  /**
+   * Replace the Hamiltonian of replica group `group` (of every group if
+   * group < 0) with the one described in a latfile.
+   */
+  void load_latfile(const std::string& latfile, int group=-1) {
+    swap_lattice(std::make_shared<const Lattice>(latfile), group);
+  }
+
+  /**
+   * Replace the Hamiltonian of replica group `group` (of every group if
+   * group < 0) with the one described by arrays of links (see Lattice).
+   * No file I/O is involved.
+   */
+  void load_hamiltonian(const int* rows, const int* cols, const double* vals,
+    size_t nlinks, int group=-1) {
+    swap_lattice(std::make_shared<const Lattice>(rows, cols, vals, nlinks),
+      group);
+  }
+
+  /**
+   * Whether every replica group has a Hamiltonian.
+   */
+  bool has_hamiltonian() const {
+    for (const auto& lattice : lattices) {
+      if (!lattice) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+  int num_groups() const {
+    return lattices.size();
+  }
+
+  /**
+   * L if the Hamiltonian of every group is an L x L torus, which is then
+   * swept with the torus stencil (see Lattice::torus_size), else 0.
+   */
+  int torus_size() const {
+    size_t L = 0;
+    for (const auto& lattice : lattices) {
+      if (!lattice || !lattice->torus_size()
+        || (L && lattice->torus_size() != L)) {
+        return 0;
+      }
+      L = lattice->torus_size();
+    }
+    return L;
+  }
+
+  /**
+   * Whether tori are swept with the torus stencil (the default) or as
+   * generic coupling graphs.  With the rejection-free kernel off, a seeded
+   * run gives identical results either way; with it on, its bins are
+   * filled in neighbour order, so the two sample the same distribution
+   * but not the same trajectory.
+   */
+  void set_stencil(bool enabled) {
+    stencil = enabled;
+    for (Algorithm& a : alg) {
+      a.use_stencil = stencil;
+    }
+  }
+
+
+  /**
+   * Reinitialize the replicas at inverse temperature beta, drawing the
+   * spins from the generator named by kind (see Algorithm::init_spins).
+   * If shared is set, a single configuration is drawn and given to every
+   * replica.  The current Hamiltonian is kept; if none has been loaded
+   * yet, ./latfile is read.
+   *
+   * A non-negative seed makes the run reproducible: replica rep draws from
+   * a stream determined by (seed, rep) only, whatever the thread count.
+   * A negative seed seeds the replicas from the clock.
+   *
+   * If the spins cannot be initialized (an unknown kind, or an array of
+   * the wrong size below), the engine is left not reset, not half reset.
+   */
+  void reset(double beta, const std::string& kind="uniform",
+    bool shared=false, long long seed=-1) {
+    prepare_reset(beta, seed);
+
+    try {
+      if (shared) {
+        alg[0].init_spins(kind);
+        std::vector<int> spins(num_spins());
+        alg[0].get_spins(spins.data());
+        for (size_t rep=1; rep < nreps; rep++) {
+          alg[rep].set_spins(spins.data());
+        }
+      } else {
+        for (size_t rep=0; rep < nreps; rep++) {
+          alg[rep].init_spins(kind);
+        }
+      }
+    } catch (...) {
+      alg.clear();
+      throw;
+    }
+  }
+
+  /**
+   * Reinitialize the replicas at inverse temperature beta from an array of
+   * either num_spins() values, shared by every replica, or
+   * num_reps()*num_spins() values, one row per replica.  See above for
+   * the seed.
+   */
+  void reset(double beta, const int* spins, size_t size, long long seed=-1) {
+    prepare_reset(beta, seed);
+    try {
+      set_spins(spins, size);
+    } catch (...) {
+      alg.clear();
+      throw;
+    }
+  }
+
+
+  /**
+   * Overwrite the spins of the replicas; see reset(beta, spins, size).
+   */
+  void set_spins(const int* spins, size_t size) {
+    check_ready();
+    const size_t n = num_spins();
+
+    if (size != n && size != nreps * n) {
+      throw std::invalid_argument("initial spins must have num_spins or "
+        "num_reps*num_spins entries");
+    }
+
+    for (size_t rep=0; rep < nreps; rep++) {
+      alg[rep].set_spins(size == n ? spins : spins + rep * n);
+    }
+  }
+
+
+  void run(unsigned int nsweeps, double dbeta) {
+    dbeta = prepare_run(dbeta);
+
+    if (houdayer_rate > 0) {
+      run_segments(nsweeps,
+        [&](size_t rep, size_t sweep) {
+          incr_current_beta(dbeta / nsweeps, rep);
+          sweep_replica(rep, sweep);
+        },
+        [&](size_t) { houdayer_updates(1); });
+      return;
+    }
+
+    // Replicas are handed out one at a time, so no thread idles at the
+    // tail when nreps is not a multiple of the thread count.
+    #pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+    for (size_t rep = 0; rep < nreps; rep++) {
+      run_replica(rep, nsweeps, dbeta);
+    }
+
+  }
+
+  /**
+   * Equivalent to run(nsweeps, dbetas[k]) for k = 0 .. n-1 in turn, in a
+   * single call: every replica works through the whole sequence on its
+   * own, applying run()'s check on the beta increment to its own beta.
+   */
+  void run_sequence(const double* dbetas, size_t n, unsigned int nsweeps) {
+    check_ready();
+
+    auto run_entry = [&](size_t rep, size_t k) {
+      double dbeta = dbetas[k];
+      if (alg[rep].beta + dbeta < 0.000001) {
+        dbeta = 0.0;
+      }
+      run_replica(rep, nsweeps, dbeta);
+    };
+
+    if (houdayer_rate > 0) {
+      run_segments(n, run_entry, [&](size_t) { houdayer_updates(nsweeps); });
+      return;
+    }
+
+    #pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+    for (size_t rep = 0; rep < nreps; rep++) {
+      for (size_t k = 0; k < n; ++k) {
+        run_entry(rep, k);
+      }
+    }
+  }
+
+  /**
+   * Check that the engine can run and return the beta increment that
+   * run(nsweeps, dbeta) actually applies.
+   */
+  double prepare_run(double dbeta) const {
+    check_ready();
+
+    //check to make sure the temperature update is legal.
+    //set dbeta to 0 if illegal so T is not updated during
+    //sweeps
+    if (alg[0].beta + dbeta < 0.000001) {
+      dbeta = 0.0;
+    }
+    return dbeta;
+  }
+
+  /**
+   * The work of run() for a single replica, with dbeta as returned by
+   * prepare_run.  Different replicas may be run concurrently.
+   */
+  void run_replica(size_t rep, unsigned int nsweeps, double dbeta) {
+    for (size_t sweep = 0; sweep < nsweeps; ++sweep) {
+      incr_current_beta(dbeta / nsweeps, rep);
+      sweep_replica(rep, sweep);
+    }
+  }
+
+  /**
+   * One Metropolis sweep of replica rep, followed by its share of Wolff
+   * moves (see set_cluster_moves).  The sweep is made by the
+   * rejection-free kernel while the replica's last sweep accepted less
+   * than the threshold of set_rejection_free.
+   */
+  void sweep_replica(size_t rep, size_t sweep) {
+    Algorithm& a = alg[rep];
+    if (a.last_acceptance < rejection_free_threshold && a.beta > 0) {
+      a.do_sweep_rejection_free(sweep);
+    } else {
+      a.do_sweep(sweep);
+    }
+    if (wolff_rate > 0) {
+      alg[rep].wolff_updates(wolff_rate);
+    }
+  }
+
+
+  /**
+   * Anneal through an arbitrary schedule in a single call: for each entry
+   * of betas, every replica is set to that inverse temperature and swept
+   * sweeps_per_beta times.  For each k < nrecord, the replica energies
+   * after schedule entry record[k] are written to
+   * energies[k*num_reps() .. (k+1)*num_reps()).
+   *
+   * With resample set, this is population annealing: before the sweeps
+   * of every entry, the replicas of each group are resampled (see
+   * resample) for the step from their current beta to the entry's.
+   */
+  void run_schedule(const double* betas, size_t nbetas,
+    unsigned sweeps_per_beta, const int* record, size_t nrecord,
+    double* energies, bool resample=false) {
+    check_ready();
+
+    for (size_t k = 0; k < nrecord; ++k) {
+      if (record[k] < 0 || size_t(record[k]) >= nbetas) {
+        throw std::invalid_argument("record indices must lie within the "
+          "schedule");
+      }
+    }
+
+    auto sweep_entry = [&](size_t rep, size_t b) {
+      alg[rep].beta = betas[b];
+      for (unsigned i = 0; i < sweeps_per_beta; ++i) {
+        sweep_replica(rep, b * sweeps_per_beta + i);
+      }
+      for (size_t k = 0; k < nrecord; ++k) {
+        if (size_t(record[k]) == b) {
+          energies[k * nreps + rep] = alg[rep].get_energy();
+        }
+      }
+    };
+
+    if (!resample && houdayer_rate <= 0) {
+      #pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+      for (size_t rep = 0; rep < nreps; rep++) {
+        for (size_t b = 0; b < nbetas; ++b) {
+          sweep_entry(rep, b);
+        }
+      }
+      return;
+    }
+
+    if (resample && nbetas > 0) {
+      resample_to(betas[0]);
+    }
+    run_segments(nbetas, sweep_entry, [&](size_t b) {
+      houdayer_updates(sweeps_per_beta);
+      if (resample && b + 1 < nbetas) {
+        resample_to(betas[b + 1]);
+      }
+    });
+  }
+
+  /**
+   * Population annealing resampling for a step of dbeta, applied to every
+   * group separately.  Replica r of a group is given the weight
+   * exp(-dbeta*E_r), normalized over the group, and the group is replaced
+   * by a systematic resample of itself: replica r is copied about
+   * group_size*weight times, so low energy states multiply and high
+   * energy ones die out, and the group keeps its size.  The betas are
+   * left unchanged.
+   */
+  void resample(double dbeta) {
+    check_ready();
+    for (size_t g = 0; g < lattices.size(); ++g) {
+      resample_group(g, dbeta);
+    }
+  }
+
+  /**
+   * The normalized resampling weights of the last resample, which sum to
+   * one over every group; 1/group_size each before the first.
+   */
+  void get_population_weights(double* arr) const {
+    check_ready();
+    std::copy(population_weights.begin(), population_weights.end(), arr);
+  }
+
+  /**
+   * For every group, the sum over resampling steps since reset of the
+   * log of the mean weight: an estimate of log(Z(beta)/Z(beta0)), the
+   * free energy difference between the current and the initial beta.
+   */
+  void get_log_partition_ratio(double* arr) const {
+    check_ready();
+    std::copy(log_partition_ratio.begin(), log_partition_ratio.end(), arr);
+  }
+
+  /**
+   * The family of every replica: the replica, at the last reset, that
+   * its configuration descends from through resampling.
+   */
+  void get_families(int* arr) const {
+    check_ready();
+    std::copy(family.begin(), family.end(), arr);
+  }
+
+
+  /**
+   * Sweep replicas with the rejection-free kernel
+   * (Algorithm::do_sweep_rejection_free) while their acceptance ratio,
+   * as of their last sweep, is below threshold; 0 turns it off.  Both
+   * kernels sample the same process, so this only changes the cost of
+   * sweeps.  Kept across reset.
+   */
+  void set_rejection_free(double threshold) {
+    if (!(threshold >= 0 && threshold <= 1)) {
+      throw std::invalid_argument("the rejection-free threshold must lie "
+        "in [0, 1]");
+    }
+    rejection_free_threshold = threshold;
+  }
+
+  /**
+   * The number of sweeps, over all replicas, made by the rejection-free
+   * kernel since reset.
+   */
+  long long rejection_free_sweeps() const {
+    check_ready();
+    long long sweeps = 0;
+    for (const Algorithm& a : alg) {
+      sweeps += a.rejection_free_sweeps;
+    }
+    return sweeps;
+  }
+
+
+  /**
+   * Interleave cluster moves with the Metropolis sweeps, at the given
+   * average number of moves per sweep:
+   *   wolff_rate    : Wolff moves per replica (see
+   *                   Algorithm::wolff_update), made after its sweeps;
+   *   houdayer_rate : Houdayer moves per pair of replicas at the same
+   *                   beta (see houdayer_move).  They are made between
+   *                   sweeps by run, run_sequence, run_schedule and
+   *                   run_tempering, but not by run_batch.
+   * The rates are kept across reset; 0 turns a kind of move off.
+   */
+  void set_cluster_moves(double wolff, double houdayer) {
+    if (!(wolff >= 0) || !(houdayer >= 0)) {
+      throw std::invalid_argument("cluster move rates must not be "
+        "negative");
+    }
+    wolff_rate = wolff;
+    houdayer_rate = houdayer;
+  }
+
+  /**
+   * Cluster move statistics since reset: the accepted Wolff moves and
+   * their mean size, and the Houdayer moves and their mean size.
+   */
+  void get_cluster_stats(double* arr) const {
+    check_ready();
+    unsigned long moves = 0;
+    unsigned long spins = 0;
+    for (const Algorithm& a : alg) {
+      moves += a.cluster_moves;
+      spins += a.cluster_spins;
+    }
+    arr[0] = moves;
+    arr[1] = moves ? double(spins) / moves : 0.0;
+    arr[2] = houdayer_moves;
+    arr[3] = houdayer_moves ? double(houdayer_spins) / houdayer_moves : 0.0;
+  }
+
+  static const int CLUSTER_STATS = 4;
+
+
+  /**
+   * Set up parallel tempering (replica exchange) with a ladder of n
+   * inverse temperatures.  The replicas of every group are split into
+   * chains of n consecutive replicas, and the replicas of a chain are
+   * given the n betas of the ladder.  If a ladder of the same size was
+   * already set, every replica keeps its position in the ladder and only
+   * the betas change, so the ladder may be adapted between runs.  The
+   * exchange statistics are cleared.
+   */
+  void set_ladder(const double* betas, size_t n) {
+    check_ready();
+    const size_t group_size = nreps / lattices.size();
+    if (n < 2 || group_size % n != 0) {
+      throw std::invalid_argument("the ladder must have at least two "
+        "betas, and their number must divide the replicas per group");
+    }
+    for (size_t k = 0; k < n; ++k) {
+      if (!(betas[k] > 0)) {
+        throw std::invalid_argument("the betas of the ladder must be "
+          "positive");
+      }
+    }
+
+    if (n != ladder.size()) {
+      slot_replica.resize(nreps);
+      for (size_t rep = 0; rep < nreps; ++rep) {
+        slot_replica[rep] = rep;
+      }
+    }
+    ladder.assign(betas, betas + n);
+    for (size_t slot = 0; slot < nreps; ++slot) {
+      alg[slot_replica[slot]].beta = ladder[slot % n];
+    }
+    exchange_attempts.assign(n - 1, 0);
+    exchange_accepts.assign(n - 1, 0);
+  }
+
+  int ladder_size() const {
+    return ladder.size();
+  }
+
+  void get_ladder(double* arr) const {
+    std::copy(ladder.begin(), ladder.end(), arr);
+  }
+
+  /**
+   * Run nsweeps sweeps at the fixed betas of the ladder, attempting an
+   * exchange of configurations between neighbouring betas of every chain
+   * after every interval sweeps.  Even and odd pairs of the ladder are
+   * attempted in alternate rounds.  An exchange between betas b and b'
+   * of replicas with energies E and E' is accepted with probability
+   * min(1, exp((b - b')(E - E'))); it swaps the betas of the two replicas
+   * rather than their spins.
+   */
+  void run_tempering(unsigned int nsweeps, unsigned int interval) {
+    check_ready();
+    if (ladder.empty()) {
+      throw std::runtime_error("set_ladder must be called before "
+        "run_tempering");
+    }
+    if (interval == 0) {
+      throw std::invalid_argument("the exchange interval must be positive");
+    }
+
+    const size_t nsegments = (nsweeps + interval - 1) / interval;
+    run_segments(nsegments,
+      [&](size_t rep, size_t segment) {
+        const size_t first = segment * interval;
+        const size_t last = std::min<size_t>(first + interval, nsweeps);
+        for (size_t sweep = first; sweep < last; ++sweep) {
+          sweep_replica(rep, sweep);
+        }
+      },
+      [&](size_t segment) {
+        houdayer_updates(std::min<size_t>(interval,
+          nsweeps - segment * interval));
+        exchange();
+      });
+  }
+
+  /**
+   * The fraction of accepted exchanges between ladder positions k and
+   * k+1, for k = 0 .. ladder_size()-2, since set_ladder.  Pairs that have
+   * not been attempted read 0.
+   */
+  void get_exchange_acceptance(double* arr) const {
+    for (size_t k = 0; k < exchange_attempts.size(); ++k) {
+      arr[k] = exchange_attempts[k]
+        ? double(exchange_accepts[k]) / exchange_attempts[k] : 0.0;
+    }
+  }
+
+  /**
+   * The replica at every position of every chain's ladder:
+   * arr[c*ladder_size() + k] is the replica of chain c at beta k.
+   */
+  void get_ladder_replicas(int* arr) const {
+    if (ladder.empty()) {
+      throw std::runtime_error("no ladder has been set");
+    }
+    for (size_t slot = 0; slot < nreps; ++slot) {
+      arr[slot] = slot_replica[slot];
+    }
+  }
+
+
+  /**
+   * Start run(nsweeps, dbeta) on a background thread and return at once.
+   * The engine must not be touched until wait() has returned.
+   */
+  void run_async(unsigned int nsweeps, double dbeta) {
+    wait();
+    check_ready();
+
+    running = true;
+    worker = std::thread([this, nsweeps, dbeta]() {
+      try {
+        run(nsweeps, dbeta);
+      } catch (...) {
+        error = std::current_exception();
+      }
+      running = false;
+    });
+  }
+
+  /**
+   * Block until a run started by run_async has finished, and rethrow any
+   * exception it raised.  Returns at once if nothing is running.
+   */
+  void wait() {
+    // Callers may wait from several threads at once
+    std::lock_guard<std::mutex> lock(wait_mutex);
+    if (worker.joinable()) {
+      worker.join();
+    }
+    if (error) {
+      std::exception_ptr e = error;
+      error = nullptr;
+      std::rethrow_exception(e);
+    }
+  }
+
+  bool is_running() const {
+    return running;
+  }
+
+
+  float get_acceptance_ratio() {
+    check_ready();
+    int accepted_flips=0;
+    int total_flips=0;
+    for (size_t rep=0; rep<nreps; rep++) {
+      accepted_flips += alg[rep].accepts;
+      total_flips += alg[rep].totals;
+      alg[rep].reset_acceptance();
+    }
+
+    return float(accepted_flips) / float(total_flips);
+  }
+
+
+  double get_average_energy() {
+    check_ready();
+    double summ = 0;
+    for (size_t rep=0; rep<nreps; rep++) {
+      summ += alg[rep].get_energy();
+    }
+    return summ / nreps / num_spins();
+  }
+
+
+  double get_average_absolute_magnetization() {
+    check_ready();
+    double configSum=0;
+    for (size_t rep=0; rep<nreps; rep++) {
+      configSum += std::abs(double(alg[rep].get_magnetization())) / num_spins();
+    }
+    return configSum / nreps;
+  }
+
+
+  /**
+   * Read the whole observable state in one pass over the replicas.  spins
+   * receives num_reps()*num_spins() values (+1/-1), or is skipped if null;
+   * energies receives the num_reps() replica energies; scalars receives
+   * SNAPSHOT_SCALARS values in the order
+   *   beta, average absolute magnetization, average energy, acceptance
+   * with the same meaning as the individual getters.  As with
+   * get_acceptance_ratio, the acceptance counters are reset.  The spins
+   * may be written as doubles or as int8 (see spin_view).
+   */
+  template <typename spin_type>
+  void snapshot(spin_type* spins, double* energies, double* scalars) {
+    check_ready();
+    const size_t n = num_spins();
+
+    double beta = 0;
+    double magnetization = 0;
+    double energy = 0;
+    int accepted_flips = 0;
+    int total_flips = 0;
+
+    for (size_t rep=0; rep<nreps; rep++) {
+      Algorithm& a = alg[rep];
+
+      if (spins) {
+        a.get_spins(spins + rep * n);
+      }
+
+      energies[rep] = a.get_energy();
+      beta += a.beta;
+      magnetization += std::abs(double(a.get_magnetization())) / n;
+      energy += a.get_energy();
+      accepted_flips += a.accepts;
+      total_flips += a.totals;
+      a.reset_acceptance();
+    }
+
+    scalars[0] = beta / nreps;
+    scalars[1] = magnetization / nreps;
+    scalars[2] = energy / nreps / n;
+    scalars[3] = float(accepted_flips) / float(total_flips);
+  }
+
+  static const int SNAPSHOT_SCALARS = 4;
+
+  /**
+   * As snapshot, but the spins go to the engine-owned int8 buffer returned
+   * by spin_view.
+   */
+  void snapshot_view(double* energies, double* scalars) {
+    check_ready();
+    snapshot(view_buffer.data(), energies, scalars);
+  }
+
+  /**
+   * The engine-owned num_reps() x num_spins() int8 buffer that
+   * snapshot_view fills.  It is allocated by reset() and keeps its address
+   * until the engine is destroyed.  Every call counts as a live view until
+   * the matching release_spin_view; while any view is live, a reset that
+   * would have to grow the buffer is refused.
+   */
+  int8_t* spin_view() {
+    check_ready();
+    ++live_views;
+    return view_buffer.data();
+  }
+
+  void release_spin_view() {
+    if (live_views > 0) {
+      --live_views;
+    }
+  }
+
+
+  int num_reps() const {
+    return nreps;
+  }
+
+  int num_threads() const {
+    return n_threads;
+  }
+
+  int num_spins() const {
+    for (const auto& lattice : lattices) {
+      if (lattice) {
+        return lattice->num_sites();
+      }
+    }
+    return 0;
+  }
+
+
+  void get_all_energies(double* arr) {
+    check_ready();
+    for (size_t rep=0; rep<nreps; rep++) {
+      arr[rep] = alg[rep].get_energy();
+    }
+  }
+
+
+  void print_lattice() {
+    check_ready();
+    for (size_t rep=0; rep < nreps; rep++) {
+      for (int spin=0; spin<alg[rep].num_sites(); spin++) {
+        std::cout << alg[rep].get_site(spin) << " ";
+      }
+      std::cout << std::endl;
+    }
+  }
+
+
+  void get_lattice(double* arr) {
+    check_ready();
+    size_t i=0;
+    for (size_t rep=0; rep<nreps; rep++) {
+      for (int spin=0; spin<alg[rep].num_sites(); spin++) {
+        arr[i++] = alg[rep].get_site(spin) == 1 ? 1 : -1;
+      }
+    }
+  }
+
+
+  void set_current_beta(double beta) {
+    check_ready();
+    for (size_t rep=0; rep<nreps; rep++) {
+      alg[rep].beta = beta;
+    }
+  }
+
+
+  double get_current_beta() const {
+    check_ready();
+    double _beta = 0;
+    for (size_t rep=0; rep<nreps; rep++) {
+      _beta += alg[rep].beta;
+    }
+    return _beta / nreps;
+  }
+
+private:
+
+  /**
+   * Run nsegments segments of work inside one parallel region.  In every
+   * segment, sweep(rep, segment) is called for every replica, spread
+   * over the threads; once all replicas are done, sync(segment) is
+   * called by a single thread before the next segment starts.
+   */
+  template <typename Sweep, typename Sync>
+  void run_segments(size_t nsegments, Sweep sweep, Sync sync) {
+    #pragma omp parallel num_threads(n_threads)
+    for (size_t segment = 0; segment < nsegments; ++segment) {
+      #pragma omp for schedule(dynamic, 1)
+      for (size_t rep = 0; rep < nreps; rep++) {
+        sweep(rep, segment);
+      }
+      #pragma omp single
+      sync(segment);
+    }
+  }
+
+  /**
+   * Resample every group for the step from its current beta to beta.
+   */
+  void resample_to(double beta) {
+    const size_t group_size = nreps / lattices.size();
+    for (size_t g = 0; g < lattices.size(); ++g) {
+      resample_group(g, beta - alg[g * group_size].beta);
+    }
+  }
+
+  void resample_group(size_t g, double dbeta) {
+    const size_t group_size = nreps / lattices.size();
+    const size_t first = g * group_size;
+    double* weights = population_weights.data() + first;
+
+    // Equal weights: every replica keeps exactly one copy
+    if (dbeta == 0) {
+      std::fill(weights, weights + group_size, 1.0 / group_size);
+      return;
+    }
+
+    // Weights relative to the energy that minimises dbeta*E, the lowest
+    // one when beta grows and the highest when it falls, so that none
+    // overflows
+    double reference = alg[first].get_energy();
+    for (size_t r = 0; r < group_size; ++r) {
+      const double energy = alg[first + r].get_energy();
+      reference = dbeta > 0 ? std::min(reference, energy)
+                            : std::max(reference, energy);
+    }
+    double sum = 0;
+    for (size_t r = 0; r < group_size; ++r) {
+      weights[r] = std::exp(-dbeta * (alg[first + r].get_energy() - reference));
+      sum += weights[r];
+    }
+    log_partition_ratio[g] += -dbeta * reference + std::log(sum / group_size);
+
+    // Systematic resampling: group_size evenly spaced points, with a
+    // random offset, against the cumulative weights
+    std::vector<size_t> copies(group_size, 0);
+    const double offset = ensemble_random.next_unit_real();
+    double cumulative = 0;
+    size_t point = 0;
+    for (size_t r = 0; r < group_size; ++r) {
+      weights[r] /= sum;
+      cumulative += weights[r] * group_size;
+      while (point < group_size && point + offset < cumulative) {
+        copies[r]++;
+        point++;
+      }
+    }
+    // Rounding may leave the last point unassigned
+    copies[group_size - 1] += group_size - point;
+
+    // Replicas with no copies are overwritten by the extra copies of the
+    // others; a replica with at least one copy keeps its state.
+    size_t target = 0;
+    for (size_t r = 0; r < group_size; ++r) {
+      for (size_t c = 1; c < copies[r]; ++c) {
+        while (copies[target] != 0) {
+          target++;
+        }
+        alg[first + target].copy_state(alg[first + r]);
+        family[first + target] = family[first + r];
+        copies[target] = 1;
+      }
+    }
+  }
+
+  /**
+   * Make houdayer_rate Houdayer moves per pair for every one of sweeps
+   * sweeps, as the fractional rates add up.  Without a ladder, replicas
+   * 2m and 2m+1 of every group are paired; with one, the replicas at the
+   * same beta of chains 2c and 2c+1 of every group.
+   */
+  void houdayer_updates(size_t sweeps) {
+    if (houdayer_rate <= 0) {
+      return;
+    }
+    houdayer_credit += houdayer_rate * sweeps;
+
+    const size_t group_size = nreps / lattices.size();
+    for (; houdayer_credit >= 1; houdayer_credit -= 1) {
+      if (ladder.empty()) {
+        for (size_t a = 0; a + 1 < nreps; a += 2) {
+          if (a / group_size == (a + 1) / group_size) {
+            houdayer_move(a, a + 1);
+          }
+        }
+      } else {
+        const size_t n = ladder.size();
+        for (size_t chain = 0; chain + 2 * n <= nreps; chain += 2 * n) {
+          if (chain / group_size != (chain + n) / group_size) {
+            continue;
+          }
+          for (size_t k = 0; k < n; ++k) {
+            houdayer_move(slot_replica[chain + k], slot_replica[chain + n + k]);
+          }
+        }
+      }
+    }
+  }
+
+  /**
+   * One Houdayer move between replicas a and b of the same Hamiltonian:
+   * a cluster of sites where they differ is grown from a random such
+   * site over the couplings, and flipped in both replicas.  This swaps
+   * the cluster between them and leaves their total energy unchanged,
+   * so it is always accepted.
+   */
+  void houdayer_move(size_t a, size_t b) {
+    Algorithm& x = alg[a];
+    Algorithm& y = alg[b];
+    const Lattice& lattice = *lattices[a / (nreps / lattices.size())];
+    const uint32_t* offsets = lattice.offsets();
+    const uint32_t* neighbors = lattice.neighbors();
+    const size_t n = x.num_sites();
+
+    houdayer_sites.clear();
+    for (size_t i = 0; i < n; ++i) {
+      if (x.get_site(i) != y.get_site(i)) {
+        houdayer_sites.push_back(i);
+      }
+    }
+    if (houdayer_sites.empty()) {
+      return;
+    }
+
+    houdayer_mark.assign(n, 0);
+    const uint32_t start = houdayer_sites[
+      ensemble_random.next_index(uint32_t(houdayer_sites.size()))];
+    houdayer_sites.clear();
+    houdayer_sites.push_back(start);
+    houdayer_mark[start] = 1;
+    for (size_t c = 0; c < houdayer_sites.size(); ++c) {
+      const uint32_t i = houdayer_sites[c];
+      for (uint32_t k = offsets[i]; k < offsets[i + 1]; ++k) {
+        const uint32_t j = neighbors[k];
+        if (!houdayer_mark[j] && x.get_site(j) != y.get_site(j)) {
+          houdayer_mark[j] = 1;
+          houdayer_sites.push_back(j);
+        }
+      }
+    }
+
+    for (const uint32_t i : houdayer_sites) {
+      x.flip_spin(i);
+      y.flip_spin(i);
+    }
+    houdayer_moves++;
+    houdayer_spins += houdayer_sites.size();
+  }
+
+  /**
+   * One round of exchange attempts on every chain of the ladder.
+   */
+  void exchange() {
+    const size_t n = ladder.size();
+    const size_t parity = exchange_round++ & 1;
+
+    for (size_t chain = 0; chain < nreps; chain += n) {
+      for (size_t k = parity; k + 1 < n; k += 2) {
+        size_t& i = slot_replica[chain + k];
+        size_t& j = slot_replica[chain + k + 1];
+        const double delta = (ladder[k] - ladder[k + 1])
+          * (alg[i].get_energy() - alg[j].get_energy());
+
+        exchange_attempts[k]++;
+        if (delta >= 0 || ensemble_random.next_unit_real() < std::exp(delta)) {
+          std::swap(alg[i].beta, alg[j].beta);
+          std::swap(i, j);
+          exchange_accepts[k]++;
+        }
+      }
+    }
+  }
+
+  /**
+   * Swap in a new Hamiltonian for one group, or for all of them if
+   * group < 0.  The replicas are discarded and must be reinitialized with
+   * reset() before the engine can run again.
+   */
+  void swap_lattice(std::shared_ptr<const Lattice> new_lattice, int group) {
+    if (group >= int(lattices.size())) {
+      throw std::invalid_argument("replica group " + std::to_string(group)
+        + " does not exist");
+    }
+
+    if (group < 0) {
+      for (auto& lattice : lattices) {
+        lattice = new_lattice;
+      }
+    } else {
+      for (size_t g = 0; g < lattices.size(); ++g) {
+        if (int(g) != group && lattices[g]
+          && lattices[g]->num_sites() != new_lattice->num_sites()) {
+          throw std::invalid_argument("all replica groups must have the "
+            "same number of spins");
+        }
+      }
+      lattices[group] = new_lattice;
+    }
+
+    alg.clear();
+  }
+
+  void prepare_reset(double beta, long long seed) {
+    if (num_spins() == 0) {
+      load_latfile("./latfile");
+    }
+    if (!has_hamiltonian()) {
+      throw std::runtime_error("every replica group needs a Hamiltonian "
+        "before reset");
+    }
+    make_algorithm_objects();
+
+    for (size_t rep=0; rep < nreps; rep++) {
+      alg[rep].beta = beta;
+      if (seed < 0) {
+        alg[rep].seed(rep);
+      } else {
+        alg[rep].seed(uint64_t(seed), rep);
+      }
+    }
+
+    // The exchange, resampling and Houdayer stream is kept apart from
+    // every replica's stream
+    exchange_round = 0;
+    houdayer_credit = 0;
+    houdayer_moves = 0;
+    houdayer_spins = 0;
+    if (seed < 0) {
+      struct timespec ts;
+      clock_gettime(CLOCK_MONOTONIC, &ts);
+      ensemble_random.seed(~uint64_t(ts.tv_nsec));
+    } else {
+      ensemble_random.seed(~uint64_t(seed));
+    }
+  }
+
+  void check_ready() const {
+    if (alg.empty()) {
+      throw std::runtime_error("the annealer must be reset after a "
+        "Hamiltonian is loaded");
+    }
+  }
+
+  void make_algorithm_objects() {
+    const size_t view_size = size_t(nreps) * num_spins();
+    if (live_views > 0 && view_size > view_buffer.capacity()) {
+      throw std::invalid_argument("cannot reset to more spins while spin "
+        "views of the annealer are alive");
+    }
+    const size_t group_size = nreps / lattices.size();
+    ladder.clear();
+    alg.clear();
+    alg.reserve(nreps);
+    for (size_t rep = 0; rep < nreps; rep++) {
+      alg.push_back(Algorithm(lattices[rep / group_size]));
+      alg.back().use_stencil = stencil;
+    }
+    population_weights.assign(nreps, 1.0 / group_size);
+    log_partition_ratio.assign(lattices.size(), 0.0);
+    family.resize(nreps);
+    for (size_t rep = 0; rep < nreps; rep++) {
+      family[rep] = rep;
+    }
+    view_buffer.resize(view_size);
+  }
+
+  void incr_current_beta(double incr, size_t rep) {
+    if (alg[rep].beta + incr > 0.000001) {
+      alg[rep].beta += incr;
+    }
+  }
+
+  unsigned nreps;
+
+  /**
+   * The Hamiltonian of every replica group
+   */
+  std::vector<std::shared_ptr<const Lattice> > lattices;
+
+  unsigned n_threads;
+
+  bool stencil = true;
+
+  std::vector<Algorithm> alg;
+
+  std::vector<int8_t> view_buffer;
+
+  unsigned live_views = 0;
+
+  /**
+   * Parallel tempering: the betas of the ladder, the replica at every
+   * position of every chain, and the exchange statistics per ladder pair
+   */
+  std::vector<double> ladder;
+
+  std::vector<size_t> slot_replica;
+
+  std::vector<unsigned long> exchange_attempts;
+
+  std::vector<unsigned long> exchange_accepts;
+
+  unsigned long exchange_round = 0;
+
+  /**
+   * Population annealing: the weights of the last resample, the free
+   * energy estimate of every group, and the family of every replica
+   */
+  std::vector<double> population_weights;
+
+  std::vector<double> log_partition_ratio;
+
+  std::vector<int> family;
+
+  /**
+   * Kernel selection and cluster moves: the rates, and the Houdayer
+   * statistics and scratch space
+   */
+  double rejection_free_threshold = 0.05;
+
+  double wolff_rate = 0;
+
+  double houdayer_rate = 0;
+
+  double houdayer_credit = 0;
+
+  unsigned long houdayer_moves = 0;
+
+  unsigned long houdayer_spins = 0;
+
+  std::vector<uint32_t> houdayer_sites;
+
+  std::vector<uint8_t> houdayer_mark;
+
+  /**
+   * Random stream of the exchanges, the resampling and the Houdayer moves
+   */
+  random_number_generator<xoshiro256ss> ensemble_random;
+
+  std::thread worker;
+
+  std::mutex wait_mutex;
+
+  std::atomic<bool> running{false};
+
+  std::exception_ptr error;
+
+};
+
+#endif
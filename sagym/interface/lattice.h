@@ -31,10 +31,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #ifndef __LATTICE_H__
 #define __LATTICE_H__
 
+#include <cmath>
 #include <vector>
 #include <string>
+#include <cstdint>
 #include <fstream>
+#include <sstream>
 #include <algorithm>
+#include <stdexcept>
 
 #include "site.h"
 
@@ -94,6 +98,127 @@ Lattice(const std::string& lattice_file) {
 
   fin.close();
 
+  index_links();
+
+}
+
+/**
+ * Build the lattice from parallel arrays of links, where entry k couples
+ * spin rows[k] to spin cols[k] with weight vals[k].  Entries with
+ * rows[k] == cols[k] are the linear (bias) terms, exactly as in a latfile.
+ */
+Lattice(const int* rows, const int* cols, const double* vals, size_t nlinks) {
+
+  if (nlinks == 0) {
+    throw std::invalid_argument("a Hamiltonian needs at least one link");
+  }
+
+  maxs = 0;
+  links.reserve(nlinks);
+
+  for (size_t k = 0; k < nlinks; ++k) {
+
+    if (rows[k] < 0 || cols[k] < 0) {
+      throw std::invalid_argument("spin indices must be non-negative");
+    }
+
+    links.push_back(Link(size_t(rows[k]), size_t(cols[k]), vals[k]));
+
+    maxs = size_t(rows[k]) > maxs ? size_t(rows[k]) : maxs;
+    maxs = size_t(cols[k]) > maxs ? size_t(cols[k]) : maxs;
+
+  }
+
+  index_links();
+
+}
+
+std::string print_index_positions() const {
+
+  std::stringstream stream;
+  stream << "[";
+
+  for (const auto& index : _index_positions) {
+    stream << index << ", ";
+  }
+
+  stream << "\b\b]";
+  return stream.str();
+
+}
+
+const std::vector<size_t>& index_positions() const {
+  return _index_positions;
+}
+
+size_t num_sites() const {
+  return nsites;
+}
+
+/**
+ * The couplings are stored once, in compressed sparse row form: the
+ * neighbours of site i are neighbors()[offsets()[i]] up to (excluding)
+ * neighbors()[offsets()[i+1]], with couplers() giving the matching weights.
+ * Every coupling appears twice, once from each end.
+ */
+const uint32_t* offsets() const {
+  return _offsets.data();
+}
+
+const uint32_t* neighbors() const {
+  return _neighbors.data();
+}
+
+const double* couplers() const {
+  return _couplers.data();
+}
+
+/**
+ * Coefficients of the linear terms
+ */
+const double* biases() const {
+  return _biases.data();
+}
+
+size_t num_neighbors(size_t i) const {
+  return _offsets[i + 1] - _offsets[i];
+}
+
+/**
+ * L if the lattice is an L x L torus of nearest-neighbour couplings with
+ * the sites in row-major order (as in latticefiles/toroidal2d), else 0.
+ * The couplings of a torus are also stored as two planes:
+ * right_couplers()[i] couples site i to its right neighbour, and
+ * down_couplers()[i] to the neighbour below.
+ */
+size_t torus_size() const {
+  return _torus;
+}
+
+const double* right_couplers() const {
+  return _right.data();
+}
+
+const double* down_couplers() const {
+  return _down.data();
+}
+
+/**
+ * An upper bound on the absolute local field of any site,
+ * max_i (|h_i| + sum_j |J_ij|)
+ */
+double max_local_field() const {
+  return _max_local_field;
+}
+
+private:
+
+/**
+ * Map the spin IDs used in the links onto contiguous positional indices,
+ * in order of first appearance.
+ */
+void index_links() {
+
   nsites = 0;
   std::vector<size_t> phys_sites(maxs + 1, size_t(-1));
   _index_positions.clear();
@@ -121,60 +246,151 @@ Lattice(const std::string& lattice_file) {
   // need this for higher ranges
   sort(links.begin(), links.end());
 
+  build_csr();
+
 }
 
-void init_sites(std::vector<site_type>& sites) const {
+/**
+ * Lay the links out as compressed sparse rows.  Within each row the
+ * neighbours keep the (sorted) order of the links.  The link list itself
+ * is released afterwards, since the replicas only ever read the rows.
+ */
+void build_csr() {
 
-  sites.reserve(nsites);
-  sites.resize(nsites);
+  if (nsites >= size_t(UINT32_MAX) || 2 * links.size() >= size_t(UINT32_MAX)) {
+    throw std::invalid_argument("lattice too large for 32-bit indices");
+  }
 
-  for (size_t i = 0; i < links.size(); ++i) {
-    const Link& link = links[i];
+  _biases.assign(nsites, 0.0);
+  _offsets.assign(nsites + 1, 0);
+
+  for (const Link& link : links) {
+    if (link.s0 != link.s1) {
+      ++_offsets[link.s0 + 1];
+      ++_offsets[link.s1 + 1];
+    }
+  }
+
+  for (size_t i = 0; i < nsites; ++i) {
+    _offsets[i + 1] += _offsets[i];
+  }
+
+  _neighbors.resize(_offsets[nsites]);
+  _couplers.resize(_offsets[nsites]);
+  std::vector<uint32_t> next(_offsets.begin(), _offsets.end() - 1);
+
+  for (const Link& link : links) {
 
     if (link.s0 == link.s1) {
 
-      sites[link.s0].local_field_bias = link.val;
+      _biases[link.s0] = link.val;
 
     } else {
 
-      sites[link.s0].neighbors.push_back(
-        neighbor_type(link.s1, link.val));
-      ++sites[link.s0].nneighbs;
+      uint32_t k = next[link.s0]++;
+      _neighbors[k] = link.s1;
+      _couplers[k] = link.val;
 
-      sites[link.s1].neighbors.push_back(
-      neighbor_type(link.s0, link.val));
-      ++sites[link.s1].nneighbs;
+      k = next[link.s1]++;
+      _neighbors[k] = link.s0;
+      _couplers[k] = link.val;
 
     }
 
   }
 
-}
+  std::vector<Link>().swap(links);
 
-std::string print_index_positions() const {
+  _max_local_field = 0;
+  for (size_t i = 0; i < nsites; ++i) {
+    double field = std::abs(_biases[i]);
+    for (uint32_t k = _offsets[i]; k < _offsets[i + 1]; ++k) {
+      field += std::abs(_couplers[k]);
+    }
+    _max_local_field = std::max(_max_local_field, field);
+  }
 
-  std::stringstream stream;
-  stream << "[";
+  detect_torus();
 
-  for (const auto& index : _index_positions) {
-    stream << index << ", ";
+}
+
+/**
+ * Recognize an L x L torus (L >= 3): every site i = r*L + c, numbered as
+ * in the links, is coupled to exactly its four neighbours, with
+ * wrap-around.
+ */
+void detect_torus() {
+
+  _torus = 0;
+  const size_t L = size_t(std::lround(std::sqrt(double(nsites))));
+  if (L < 3 || L * L != nsites) {
+    return;
+  }
+  for (size_t i = 0; i < nsites; ++i) {
+    if (_index_positions[i] != i) {
+      return;
+    }
   }
 
-  stream << "\b\b]";
-  return stream.str();
+  std::vector<double> right(nsites), down(nsites);
+  for (size_t i = 0; i < nsites; ++i) {
+    if (num_neighbors(i) != 4) {
+      return;
+    }
+    const size_t c = i % L;
+    const size_t up_site = (i + nsites - L) % nsites;
+    const size_t down_site = (i + L) % nsites;
+    const size_t left_site = c ? i - 1 : i + L - 1;
+    const size_t right_site = c + 1 < L ? i + 1 : i + 1 - L;
+
+    unsigned seen = 0;
+    for (uint32_t k = _offsets[i]; k < _offsets[i + 1]; ++k) {
+      const size_t j = _neighbors[k];
+      if (j == right_site) {
+        right[i] = _couplers[k];
+        seen |= 1;
+      } else if (j == left_site) {
+        seen |= 2;
+      } else if (j == down_site) {
+        down[i] = _couplers[k];
+        seen |= 4;
+      } else if (j == up_site) {
+        seen |= 8;
+      } else {
+        return;
+      }
+    }
+    if (seen != 15) {
+      return;
+    }
+  }
 
-}
+  _right.swap(right);
+  _down.swap(down);
+  _torus = L;
 
-const std::vector<size_t>& index_positions() const {
-  return _index_positions;
 }
 
-private:
-
   size_t nsites;
 
   std::vector<Link> links;
 
+  std::vector<uint32_t> _offsets;
+
+  std::vector<uint32_t> _neighbors;
+
+  std::vector<double> _couplers;
+
+  std::vector<double> _biases;
+
+  double _max_local_field;
+
+  size_t _torus;
+
+  std::vector<double> _right;
+
+  std::vector<double> _down;
+
   /**
   * Highest ID of any spin
   */
@@ -190,4 +406,108 @@ private:
 
 };
 
+
+/**
+ * Neighbourhoods for the sweep kernels: for_each_neighbor(i, f) calls
+ * f(j, J_ij) for every neighbour j of site i.  GraphStencil walks the
+ * compressed sparse rows of any lattice; TorusStencil computes the four
+ * neighbours of a torus by index arithmetic and reads the coupling
+ * planes, with no indirect loads.  with_stencil calls f with the stencil
+ * that suits a lattice.
+ */
+class GraphStencil {
+
+public:
+
+  explicit GraphStencil(const Lattice& lattice) :
+    offsets(lattice.offsets()),
+    neighbors(lattice.neighbors()),
+    couplers(lattice.couplers()) {
+  }
+
+  template <typename F>
+  void for_each_neighbor(uint32_t i, F f) const {
+    for (uint32_t k = offsets[i]; k < offsets[i + 1]; ++k) {
+      f(neighbors[k], couplers[k]);
+    }
+  }
+
+private:
+
+  const uint32_t* offsets;
+  const uint32_t* neighbors;
+  const double* couplers;
+
+};
+
+
+/**
+ * With a side length fixed at compile time (SIZE > 0), the index
+ * arithmetic needs no division; SIZE = 0 reads it from the lattice.
+ */
+template <uint32_t SIZE>
+class TorusStencil {
+
+public:
+
+  explicit TorusStencil(const Lattice& lattice) :
+    L(SIZE ? SIZE : lattice.torus_size()),
+    N(L * L),
+    right(lattice.right_couplers()),
+    down(lattice.down_couplers()) {
+  }
+
+  template <typename F>
+  void for_each_neighbor(uint32_t i, F f) const {
+    uint32_t up_site, down_site, left_site, right_site;
+    if (SIZE && (SIZE & (SIZE - 1)) == 0) {
+      // power of two sides wrap around by masking
+      const uint32_t row = i & ~(SIZE - 1);
+      up_site = (i - SIZE) & (SIZE * SIZE - 1);
+      down_site = (i + SIZE) & (SIZE * SIZE - 1);
+      left_site = row | ((i - 1) & (SIZE - 1));
+      right_site = row | ((i + 1) & (SIZE - 1));
+    } else {
+      const uint32_t c = SIZE ? i % SIZE : i % L;
+      up_site = i >= L ? i - L : i + N - L;
+      down_site = i + L < N ? i + L : i + L - N;
+      left_site = c ? i - 1 : i + L - 1;
+      right_site = c + 1 < L ? i + 1 : i + 1 - L;
+    }
+    f(right_site, right[i]);
+    f(left_site, right[left_site]);
+    f(down_site, down[i]);
+    f(up_site, down[up_site]);
+  }
+
+private:
+
+  const uint32_t L;
+  const uint32_t N;
+  const double* right;
+  const double* down;
+
+};
+
+
+/**
+ * Call f(stencil) with the torus stencil if the lattice is a torus and
+ * use_torus is set, else with the generic one.  The side lengths of the
+ * datasets in latticefiles/toroidal2d get a kernel of their own.
+ */
+template <typename F>
+void with_stencil(const Lattice& lattice, bool use_torus, F f) {
+  switch (use_torus ? lattice.torus_size() : 0) {
+    case 0: f(GraphStencil(lattice)); break;
+    case 4: f(TorusStencil<4>(lattice)); break;
+    case 6: f(TorusStencil<6>(lattice)); break;
+    case 8: f(TorusStencil<8>(lattice)); break;
+    case 10: f(TorusStencil<10>(lattice)); break;
+    case 12: f(TorusStencil<12>(lattice)); break;
+    case 14: f(TorusStencil<14>(lattice)); break;
+    case 16: f(TorusStencil<16>(lattice)); break;
+    default: f(TorusStencil<0>(lattice)); break;
+  }
+}
+
 #endif
@@ -32,12 +32,74 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #define __RANDOM_NUMBER_GENERATOR_H__
 
 #include <cmath>
+#include <cstdint>
+#include <cstddef>
+#include <limits>
 #include <boost/random/bernoulli_distribution.hpp>
 #include <boost/random/uniform_int_distribution.hpp>
 #include <boost/random/uniform_real_distribution.hpp>
 
 using namespace std;
 
+
+/**
+ * xoshiro256** by D. Blackman and S. Vigna: a small, fast 64-bit engine
+ * with a 2^256-1 period.  It models the boost/std engine interface, so the
+ * boost distributions can draw from it.  A 64-bit seed is expanded into
+ * the 256-bit state with splitmix64, as its authors recommend.
+ */
+class xoshiro256ss {
+
+public:
+
+    typedef uint64_t result_type;
+
+    xoshiro256ss(result_type value = 0x9e3779b97f4a7c15ULL) {
+        seed(value);
+    }
+
+    void seed(result_type value) {
+        for (auto& word : s) {
+            value += 0x9e3779b97f4a7c15ULL;
+            uint64_t z = value;
+            z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+            z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+            word = z ^ (z >> 31);
+        }
+    }
+
+    static constexpr result_type min() {
+        return 0;
+    }
+
+    static constexpr result_type max() {
+        return std::numeric_limits<result_type>::max();
+    }
+
+    result_type operator()() {
+        const uint64_t result = rotl(s[1] * 5, 7) * 9;
+        const uint64_t t = s[1] << 17;
+
+        s[2] ^= s[0];
+        s[3] ^= s[1];
+        s[1] ^= s[2];
+        s[0] ^= s[3];
+        s[2] ^= t;
+        s[3] = rotl(s[3], 45);
+
+        return result;
+    }
+
+private:
+
+    static uint64_t rotl(uint64_t x, int k) {
+        return (x << k) | (x >> (64 - k));
+    }
+
+    uint64_t s[4];
+};
+
+
 /**
  * Random number generator for SQA implementations.
  */
@@ -76,6 +138,52 @@ public:
         return uniform(_generator);
     }
 
+    /**
+     * Fill out[0 .. size) with raw engine output.  Used to draw the random
+     * numbers of a whole sweep in one tight loop.
+     */
+    void fill(typename engine_type::result_type* out, size_t size) {
+        for (size_t i = 0; i < size; ++i) {
+            out[i] = _generator();
+        }
+    }
+
+    /**
+     * An integer uniform in [0, n), from one raw 64-bit draw, with Lemire's
+     * multiply-and-shift method.  The rare biased draws are rejected and
+     * replaced with fresh engine output.  Requires a 64-bit engine.
+     */
+    uint32_t next_index(uint64_t raw, uint32_t n) {
+        uint64_t m = (raw >> 32) * n;
+        uint32_t low = uint32_t(m);
+        if (low < n) {
+            const uint32_t threshold = uint32_t(-n) % n;
+            while (low < threshold) {
+                m = (uint64_t(_generator()) >> 32) * n;
+                low = uint32_t(m);
+            }
+        }
+        return uint32_t(m >> 32);
+    }
+
+    uint32_t next_index(uint32_t n) {
+        return next_index(_generator(), n);
+    }
+
+    /**
+     * A real uniform in the open interval (0, 1), from one raw 64-bit draw.
+     */
+    static double unit_real(uint64_t raw) {
+        return ((raw >> 11) + 0.5) * (1.0 / 9007199254740992.0);
+    }
+
+    /**
+     * A real uniform in the open interval (0, 1).
+     */
+    double next_unit_real() {
+        return unit_real(_generator());
+    }
+
     double next_poisson_point_interval(double parameter) {
         return -1*log(1-next_uniform_real(0,1))/parameter;
     }
@@ -28,8 +28,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 *******************************************************************************/
 
+#include <algorithm>
+#include <utility>
 #include <string>
 #include <vector>
+#include <map>
+#include <memory>
+#include <mutex>
 #include <iostream>
 #include <iomanip>
 #include <stdexcept>
@@ -39,234 +44,466 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #include "sched.h"
 #include "output.h"
 #include "sa.h"
-#include "lattice.h"
-#include "alg.h"
-
-#ifdef _OPENMP
-#include "omp.h"
-#endif
+#include "annealer.h"
 
 using namespace std::chrono;
 using namespace TCLAP;
 
 
-string arg_latfile="./latfile";
-unsigned int arg_nreps=64;
-
-
-void incr_current_beta(double incr, size_t rep) ;
-
-
 /*##############################################
 ################################################
 ################################################
 ################################################
 ################################################*/
 
+// Engines are owned by the Python SA objects that created them and are
+// referred to across the SWIG boundary by an opaque integer handle.  The
+// registry is locked since some calls run with the GIL released.
+std::map<int, std::unique_ptr<Annealer> > engines;
+int next_handle = 0;
+std::mutex engines_mutex;
+
+Annealer& find_engine(int handle) {
+  std::lock_guard<std::mutex> lock(engines_mutex);
+  auto it = engines.find(handle);
+  if (it == engines.end()) {
+    throw std::invalid_argument("invalid annealer handle "
+      + std::to_string(handle));
+  }
+  return *it->second;
+}
 
-#ifdef _OPENMP
-    unsigned int arg_n_threads=omp_get_max_threads();
-#endif
-
-
-#ifndef _OPENMP
-    const unsigned n_threads=1;
-#else
-    const unsigned n_threads= arg_n_threads;
-#endif
+// Called around waits for an async run, so that the Python wrapper can
+// let other threads run meanwhile (see set_wait_hooks).
+void* (*wait_begin)() = nullptr;
+void (*wait_end)(void*) = nullptr;
+
+class WaitHooks {
+public:
+  explicit WaitHooks(bool waiting) :
+    active(waiting && wait_begin && wait_end),
+    state(active ? wait_begin() : nullptr) {}
+  ~WaitHooks() {
+    if (active) {
+      wait_end(state);
+    }
+  }
+private:
+  bool active;
+  void* state;
+};
+
+// Any call that touches an engine first waits for its pending async run.
+Annealer& engine(int handle) {
+  Annealer& e = find_engine(handle);
+  // Without the GIL, another thread may start a new run meanwhile
+  while (e.is_running()) {
+    WaitHooks hooks(true);
+    e.wait();
+  }
+  e.wait();
+  return e;
+}
 
-// read lattice
-Lattice lattice(arg_latfile);
+void set_wait_hooks(void* (*begin)(), void (*end)(void*)) {
+  wait_begin = begin;
+  wait_end = end;
+}
 
-vector<Algorithm> make_algorithm_objects(Lattice lattice__) {
-    vector<Algorithm> alg(arg_nreps);
+int create(unsigned int nreps, unsigned int nthreads, unsigned int ngroups) {
+  std::unique_ptr<Annealer> e(new Annealer(nreps, nthreads, ngroups));
+  std::lock_guard<std::mutex> lock(engines_mutex);
+  engines[next_handle] = std::move(e);
+  return next_handle++;
+}
 
-    for (unsigned int rep=0; rep<arg_nreps; rep++) {
-      alg[rep] = Algorithm(lattice__);
+void destroy(int handle) {
+  std::unique_ptr<Annealer> e;
+  {
+    std::lock_guard<std::mutex> lock(engines_mutex);
+    auto it = engines.find(handle);
+    if (it == engines.end()) {
+      return;
     }
-    return alg;
+    e = std::move(it->second);
+    engines.erase(it);
+  }
+  // the destructor joins any pending run, outside of the lock
+  if (e) {
+    WaitHooks hooks(e->is_running());
+    e.reset();
+  }
 }
 
-vector<Algorithm> alg = make_algorithm_objects(lattice);
-
 /*##############################################
 ################################################
 ################################################
 ################################################
 ################################################*/
 
-int reset(double beta) {
-    // read lattice
-    Lattice lattice(arg_latfile);
-    alg = make_algorithm_objects(lattice);
-    //double beta = 0.00001;
-    bool arg_neg_init = false; //("z", "neg_init", "Negative initialization", false);
-
-      for (size_t rep=0; rep < arg_nreps; rep++) {
-        alg[rep].beta = beta;
-        if (arg_neg_init) {
-          alg[rep].set_negative();
-        } else {
-          alg[rep].reset_sites(rep);
-        }
-      }
-    return 0;
+void load_latfile(int handle, const char* latfile, int group) {
+  engine(handle).load_latfile(latfile, group);
 }
 
 
-int run(unsigned int arg_nsweeps, double dbeta) {
+void load_hamiltonian(int handle, int* rows, int nrows, int* cols, int ncols,
+  double* vals, int nvals, int group) {
+  if (nrows != ncols || nrows != nvals) {
+    throw std::invalid_argument("rows, cols and couplings must have the "
+      "same length");
+  }
+  engine(handle).load_hamiltonian(rows, cols, vals, nrows, group);
+}
 
-//    std::vector<std::pair<double, std::string> > en(arg_nreps);
 
-#ifndef _OPENMP
-    const unsigned n= 0;
-#else
-    #pragma omp parallel num_threads(n_threads)
-    {
-      const unsigned n = omp_get_thread_num();
-#endif
+int has_hamiltonian(int handle) {
+  return engine(handle).has_hamiltonian();
+}
 
 
-      size_t r0 = arg_nreps * n / n_threads;
-      size_t r1 = arg_nreps * (n + 1) / n_threads;
+int get_torus_size(int handle) {
+  return engine(handle).torus_size();
+}
 
 
-      //check to make sure the temperature update is legal.
-      //set dbeta to 0 if illegal so T is not updated during
-      //sweeps
-      if (alg[0].beta + dbeta < 0.000001) {
-	      dbeta = 0.0;
-      }
+void set_stencil(int handle, int enabled) {
+  engine(handle).set_stencil(enabled);
+}
 
 
-      // main loop
-      for (size_t rep = r0; rep < r1; rep++) {
-        for (size_t sweep = 0; sweep < arg_nsweeps; ++sweep) {
-          incr_current_beta(dbeta / arg_nsweeps, rep);
-          alg[rep].do_sweep(sweep);
-        }
-//        alg[rep].get_energies(en, rep);
-      }
+int reset(int handle, double beta, const char* init, int shared,
+  long long seed) {
+  engine(handle).reset(beta, init, shared, seed);
+  return 0;
+}
 
-#ifdef _OPENMP
-    }
-#endif
 
+int reset_from_array(int handle, double beta, int* init, int ninit,
+  long long seed) {
+  engine(handle).reset(beta, init, ninit, seed);
   return 0;
-
 }
 
 
-float get_acceptance_ratio() {
-    int accepted_flips=0;
-    int total_flips=0;
-    for (size_t rep=0; rep<arg_nreps; rep++) {
-	    accepted_flips += alg[rep].accepts;
-	    total_flips += alg[rep].totals;
-	    alg[rep].reset_acceptance();
-    }
-    
-    return float(accepted_flips) / float(total_flips);
-    
+void set_lattice(int handle, int* spins, int nspins) {
+  engine(handle).set_spins(spins, nspins);
 }
 
 
-float get_average_energy() {
-    float summ = 0;
-    for (size_t rep=0; rep<arg_nreps; rep++) {
-        summ += alg[rep].get_energy();
-    }
-    return summ / arg_nreps / alg[0].num_sites();
+int run(int handle, unsigned int arg_nsweeps, double dbeta) {
+  engine(handle).run(arg_nsweeps, dbeta);
+  return 0;
 }
 
 
-float get_average_absolute_magnetization() {
-  float configSum=0;
-  float this_config_sum;
-  for (unsigned int rep=0; rep<arg_nreps; rep++) {
-    //cout << rep << alg[rep].get_configuration();
-    float spinSum=0;
-    for (int i=0; i<alg[rep].num_sites(); i++){
-      spinSum += alg[rep].get_site(i);
-    }
-    this_config_sum = abs(spinSum);
-    configSum += this_config_sum / alg[rep].num_sites();
+int run_schedule(int handle, double* betas, int nbetas,
+  unsigned int sweeps_per_beta, int* record, int nrecord,
+  double* energies, int nenergies, int resample) {
+  Annealer& e = engine(handle);
+  if (nenergies != nrecord * e.num_reps()) {
+    throw std::invalid_argument("energy buffer must have num_reps entries "
+      "per recorded schedule entry");
   }
-  return configSum / alg.size();
+  e.run_schedule(betas, nbetas, sweeps_per_beta, record, nrecord, energies,
+    resample);
+  return 0;
+}
+
 
+void resample(int handle, double dbeta) {
+  Annealer& e = engine(handle);
+  e.resample(e.prepare_run(dbeta));
 }
 
-int get_num_reps() {
-  return arg_nreps;
+
+void get_population_weights(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (size != e.num_reps()) {
+    throw std::invalid_argument("weight buffer must have one entry per rep");
+  }
+  e.get_population_weights(arr);
 }
 
-int get_num_spins(){
-  return alg[0].num_sites();
+
+void get_log_partition_ratio(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (size != e.num_groups()) {
+    throw std::invalid_argument("buffer must have one entry per group");
+  }
+  e.get_log_partition_ratio(arr);
 }
 
 
-void get_all_energies(double* arr, int size) {
-   for (int rep=0; rep<arg_nreps; rep++) {
-       arr[rep] = alg[rep].get_energy();
-   }
+void get_families(int handle, int* slots, int nslots) {
+  Annealer& e = engine(handle);
+  if (nslots != e.num_reps()) {
+    throw std::invalid_argument("family buffer must have one entry per rep");
+  }
+  e.get_families(slots);
+}
 
 
+void get_schedule(const char* kind, double beta0, double beta1,
+  double* sched, int nsched) {
+  std::vector<double> s = get_sched(kind, nsched, beta0, beta1);
+  if (s.size() != size_t(nsched)) {
+    throw std::invalid_argument("schedule " + std::string(kind) + " has "
+      + std::to_string(s.size()) + " entries, not "
+      + std::to_string(nsched));
+  }
+  std::copy(s.begin(), s.end(), sched);
 }
 
-void print_lattice() {
-   for (int rep=0; rep < arg_nreps; rep++) {
-    for (int spin=0; spin<alg[rep].num_sites(); spin++) {
-        cout << alg[rep].get_site(spin) << " ";
-      }
-      cout << endl; 
-    }
+
+int run_sequence(int handle, double* dbetas, int ndbetas,
+  unsigned int arg_nsweeps) {
+  engine(handle).run_sequence(dbetas, ndbetas, arg_nsweeps);
+  return 0;
+}
+
+
+int run_batch(int* handles, int nhandles, double* dbetas, int ndbetas,
+  unsigned int arg_nsweeps) {
+  if (nhandles != ndbetas) {
+    throw std::invalid_argument("handles and dbetas must have the same "
+      "length");
   }
- 
-  
-
-void get_lattice(double* arr, int size) {
-  int i=0;
-  for (int rep=0; rep<arg_nreps; rep++) {
-    for (int spin=0; spin<alg[rep].num_sites(); spin++) {
-      if (alg[rep].get_site(spin) == 1 ) {
-        arr[i] = 1;
-      } else {
-        arr[i] = -1;
+
+  // Every (engine, replica) pair is one work item of a single parallel
+  // loop, so small engines do not leave threads idle.
+  std::vector<Annealer*> batch;
+  std::vector<double> steps;
+  std::vector<std::pair<size_t, size_t> > items;
+  int n_threads = 1;
+
+  for (int b = 0; b < nhandles; ++b) {
+    Annealer& e = engine(handles[b]);
+    for (Annealer* other : batch) {
+      if (other == &e) {
+        throw std::invalid_argument("an engine may appear only once in a "
+          "batch");
       }
-      //arr[i] = alg[rep].get_site(spin);
-     // if (spin==0) {arr[i] = 1;}
-      i++;
     }
+    batch.push_back(&e);
+    steps.push_back(e.prepare_run(dbetas[b]));
+    n_threads = std::max(n_threads, e.num_threads());
+    for (int rep = 0; rep < e.num_reps(); ++rep) {
+      items.push_back(std::make_pair(size_t(b), size_t(rep)));
+    }
+  }
+
+  #pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+  for (size_t k = 0; k < items.size(); ++k) {
+    const size_t b = items[k].first;
+    batch[b]->run_replica(items[k].second, arg_nsweeps, steps[b]);
+  }
+  return 0;
+}
+
+
+void set_rejection_free(int handle, double threshold) {
+  engine(handle).set_rejection_free(threshold);
+}
+
+
+long long get_rejection_free_sweeps(int handle) {
+  return engine(handle).rejection_free_sweeps();
+}
+
+
+void set_cluster_moves(int handle, double wolff_rate, double houdayer_rate) {
+  engine(handle).set_cluster_moves(wolff_rate, houdayer_rate);
+}
+
+
+void get_cluster_stats(int handle, double* arr, int size) {
+  if (size != Annealer::CLUSTER_STATS) {
+    throw std::invalid_argument("cluster statistics have "
+      + std::to_string(Annealer::CLUSTER_STATS) + " entries");
   }
+  engine(handle).get_cluster_stats(arr);
 }
 
 
-void set_current_beta(double beta) {
-  for (size_t rep=0; rep<arg_nreps; rep++) {
-    alg[rep].beta = beta ;
+void set_ladder(int handle, double* betas, int nbetas) {
+  engine(handle).set_ladder(betas, nbetas);
+}
+
+
+int get_ladder_size(int handle) {
+  return engine(handle).ladder_size();
+}
+
+
+void get_ladder(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (size != e.ladder_size()) {
+    throw std::invalid_argument("ladder buffer must have ladder_size "
+      "entries");
   }
+  e.get_ladder(arr);
+}
+
+
+int run_tempering(int handle, unsigned int arg_nsweeps,
+  unsigned int interval) {
+  engine(handle).run_tempering(arg_nsweeps, interval);
+  return 0;
 }
 
-double clip_zero(double T) {
-  if (T<0) {
-    return 0;
-  } else {
-    return T;
+
+void get_exchange_acceptance(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (e.ladder_size() == 0 || size != e.ladder_size() - 1) {
+    throw std::invalid_argument("acceptance buffer must have one entry per "
+      "pair of neighbouring ladder betas");
   }
+  e.get_exchange_acceptance(arr);
 }
 
 
-void incr_current_beta(double incr, size_t rep) {
-  if (alg[rep].beta + incr > 0.000001) {
-    alg[rep].beta += incr;
+void get_ladder_replicas(int handle, int* slots, int nslots) {
+  Annealer& e = engine(handle);
+  if (nslots != e.num_reps()) {
+    throw std::invalid_argument("ladder buffer must have one entry per rep");
   }
+  e.get_ladder_replicas(slots);
+}
+
+
+int run_async(int handle, unsigned int arg_nsweeps, double dbeta) {
+  engine(handle).run_async(arg_nsweeps, dbeta);
+  return 0;
+}
+
+
+void wait_run(int handle) {
+  find_engine(handle).wait();
 }
 
-double get_current_beta() {
-  double _beta = 0;
-  for (size_t rep=0; rep<arg_nreps; rep++) {
-    _beta += alg[rep].beta;
+
+int is_running(int handle) {
+  return find_engine(handle).is_running();
+}
+
+
+float get_acceptance_ratio(int handle) {
+  return engine(handle).get_acceptance_ratio();
+}
+
+
+double get_average_energy(int handle) {
+  return engine(handle).get_average_energy();
+}
+
+
+double get_average_absolute_magnetization(int handle) {
+  return engine(handle).get_average_absolute_magnetization();
+}
+
+int get_num_reps(int handle) {
+  return engine(handle).num_reps();
+}
+
+int get_num_groups(int handle) {
+  return engine(handle).num_groups();
+}
+
+int get_num_threads(int handle) {
+  return engine(handle).num_threads();
+}
+
+int get_num_spins(int handle){
+  return engine(handle).num_spins();
+}
+
+
+void get_all_energies(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (size != e.num_reps()) {
+    throw std::invalid_argument("energy buffer must have one entry per rep");
+  }
+  e.get_all_energies(arr);
+}
+
+// Checks shared by the snapshot calls; nspins < 0 means no spins buffer.
+Annealer& snapshot_engine(int handle, int nspins, int nenergies,
+  int nscalars) {
+  Annealer& e = engine(handle);
+  if (nspins > 0 && nspins != e.num_reps() * e.num_spins()) {
+    throw std::invalid_argument("spins must have num_reps*num_spins "
+      "entries");
+  }
+  if (nenergies != e.num_reps()) {
+    throw std::invalid_argument("energies must have num_reps entries");
+  }
+  if (nscalars != Annealer::SNAPSHOT_SCALARS) {
+    throw std::invalid_argument("scalars must have "
+      + std::to_string(Annealer::SNAPSHOT_SCALARS) + " entries");
+  }
+  return e;
+}
+
+void snapshot(int handle, double* spins, int nspins, double* energies,
+  int nenergies, double* scalars, int nscalars) {
+  snapshot_engine(handle, nspins, nenergies, nscalars)
+    .snapshot(nspins ? spins : nullptr, energies, scalars);
+}
+
+void snapshot_int8(int handle, signed char* spins, int nspins,
+  double* energies, int nenergies, double* scalars, int nscalars) {
+  snapshot_engine(handle, nspins, nenergies, nscalars)
+    .snapshot(nspins ? (int8_t*)spins : nullptr, energies, scalars);
+}
+
+void snapshot_view(int handle, int nview, double* energies, int nenergies,
+  double* scalars, int nscalars) {
+  Annealer& e = snapshot_engine(handle, -1, nenergies, nscalars);
+  // nview is the size of the caller's view; the number of reps is fixed,
+  // so a size that differs means the spins no longer match
+  if (nview != e.num_reps() * e.num_spins()) {
+    throw std::invalid_argument("the view no longer matches the engine; "
+      "make a new one with new_snapshot");
+  }
+  e.snapshot_view(energies, scalars);
+}
+
+void get_spin_view(int handle, signed char** view, int* nreps, int* nspins) {
+  Annealer& e = engine(handle);
+  *view = (signed char*)e.spin_view();
+  *nreps = e.num_reps();
+  *nspins = e.num_spins();
+}
+
+void release_spin_view(int handle) {
+  // Like destroy, a no-op for handles that are already gone
+  std::lock_guard<std::mutex> lock(engines_mutex);
+  auto it = engines.find(handle);
+  if (it != engines.end()) {
+    it->second->release_spin_view();
   }
-  _beta = _beta / arg_nreps;
-  return _beta;
+}
+
+
+void print_lattice(int handle) {
+  engine(handle).print_lattice();
+}
+
+
+void get_lattice(int handle, double* arr, int size) {
+  Annealer& e = engine(handle);
+  if (size != e.num_reps() * e.num_spins()) {
+    throw std::invalid_argument("lattice buffer must have reps*spins entries");
+  }
+  e.get_lattice(arr);
+}
+
+
+void set_current_beta(int handle, double beta) {
+  engine(handle).set_current_beta(beta);
+}
+
+
+double get_current_beta(int handle) {
+  return engine(handle).get_current_beta();
 }
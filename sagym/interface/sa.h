@@ -28,15 +28,68 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 *******************************************************************************/
 
-void get_lattice(double* arr, int size);
-void get_all_energies(double* arr, int size);
-int get_num_reps();
-int get_num_spins();
-float get_average_energy();
-float get_acceptance_ratio();
-
-void set_current_beta(double beta);
-int reset(double beta);
-int run(unsigned int arg_nsweeps, double end_beta);
-double get_current_beta();
-float get_average_absolute_magnetization();
+int create(unsigned int nreps, unsigned int nthreads, unsigned int ngroups);
+void destroy(int handle);
+
+void load_latfile(int handle, const char* latfile, int group);
+void load_hamiltonian(int handle, int* rows, int nrows, int* cols, int ncols,
+  double* vals, int nvals, int group);
+int has_hamiltonian(int handle);
+int get_torus_size(int handle);
+void set_stencil(int handle, int enabled);
+
+void get_lattice(int handle, double* arr, int size);
+void get_all_energies(int handle, double* arr, int size);
+void snapshot(int handle, double* spins, int nspins, double* energies,
+  int nenergies, double* scalars, int nscalars);
+void snapshot_int8(int handle, signed char* spins, int nspins,
+  double* energies, int nenergies, double* scalars, int nscalars);
+void snapshot_view(int handle, int nview, double* energies, int nenergies,
+  double* scalars, int nscalars);
+void get_spin_view(int handle, signed char** view, int* nreps, int* nspins);
+void release_spin_view(int handle);
+void print_lattice(int handle);
+int get_num_reps(int handle);
+int get_num_groups(int handle);
+int get_num_threads(int handle);
+int get_num_spins(int handle);
+double get_average_energy(int handle);
+float get_acceptance_ratio(int handle);
+
+void set_current_beta(int handle, double beta);
+int reset(int handle, double beta, const char* init, int shared,
+  long long seed);
+int reset_from_array(int handle, double beta, int* init, int ninit,
+  long long seed);
+void set_lattice(int handle, int* spins, int nspins);
+int run(int handle, unsigned int arg_nsweeps, double end_beta);
+int run_schedule(int handle, double* betas, int nbetas,
+  unsigned int sweeps_per_beta, int* record, int nrecord,
+  double* energies, int nenergies, int resample);
+void resample(int handle, double dbeta);
+void get_population_weights(int handle, double* arr, int size);
+void get_log_partition_ratio(int handle, double* arr, int size);
+void get_families(int handle, int* slots, int nslots);
+void get_schedule(const char* kind, double beta0, double beta1,
+  double* sched, int nsched);
+int run_sequence(int handle, double* dbetas, int ndbetas,
+  unsigned int arg_nsweeps);
+int run_batch(int* handles, int nhandles, double* dbetas, int ndbetas,
+  unsigned int arg_nsweeps);
+void set_rejection_free(int handle, double threshold);
+long long get_rejection_free_sweeps(int handle);
+void set_cluster_moves(int handle, double wolff_rate, double houdayer_rate);
+void get_cluster_stats(int handle, double* arr, int size);
+void set_ladder(int handle, double* betas, int nbetas);
+int get_ladder_size(int handle);
+void get_ladder(int handle, double* arr, int size);
+int run_tempering(int handle, unsigned int arg_nsweeps,
+  unsigned int interval);
+void get_exchange_acceptance(int handle, double* arr, int size);
+void get_ladder_replicas(int handle, int* slots, int nslots);
+int run_async(int handle, unsigned int arg_nsweeps, double end_beta);
+void wait_run(int handle);
+int is_running(int handle);
+void set_wait_hooks(void* (*begin)(), void (*end)(void*));
+double get_current_beta(int handle);
+double get_average_absolute_magnetization(int handle);
@@ -22,15 +22,84 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 %module sa_interface
 %{
     #define SWIG_FILE_WITH_INIT
+    #include <stdexcept>
     #include "sa.h"
+
+    /* Releases the GIL for the lifetime of the object. */
+    class GILRelease {
+    public:
+        GILRelease() : state(PyEval_SaveThread()) {}
+        ~GILRelease() { PyEval_RestoreThread(state); }
+    private:
+        PyThreadState* state;
+    };
+
+    /* Installed as the backend's wait hooks: a call that has to wait for
+       an async run lets other Python threads run meanwhile.  Calls made
+       under RELEASE_GIL already have. */
+    static void* wait_begin_hook() {
+        return PyGILState_Check() ? PyEval_SaveThread() : nullptr;
+    }
+    static void wait_end_hook(void* state) {
+        if (state) {
+            PyEval_RestoreThread((PyThreadState*)state);
+        }
+    }
 %}
 
+%include "exception.i"
 %include "numpy.i"
 %init %{
 import_array();
+set_wait_hooks(wait_begin_hook, wait_end_hook);
 %}
 
+%exception {
+    try {
+        $action
+    } catch (const std::invalid_argument& e) {
+        SWIG_exception(SWIG_ValueError, e.what());
+    } catch (const std::exception& e) {
+        SWIG_exception(SWIG_RuntimeError, e.what());
+    }
+}
+
+/* Long-running calls do not touch Python objects, so they let other
+   Python threads run while the backend is busy. */
+%define RELEASE_GIL(function)
+%exception function {
+    try {
+        GILRelease release;
+        $action
+    } catch (const std::invalid_argument& e) {
+        SWIG_exception(SWIG_ValueError, e.what());
+    } catch (const std::exception& e) {
+        SWIG_exception(SWIG_RuntimeError, e.what());
+    }
+}
+%enddef
+
+RELEASE_GIL(run);
+RELEASE_GIL(run_schedule);
+RELEASE_GIL(run_batch);
+RELEASE_GIL(run_sequence);
+RELEASE_GIL(run_tempering);
+RELEASE_GIL(wait_run);
+
 %apply (double* ARGOUT_ARRAY1, int DIM1) { (double* arr, int size)};
 %apply (double* IN_ARRAY1, int DIM1) { (double* arr_in, int size)};
+%apply (int* IN_ARRAY1, int DIM1) { (int* rows, int nrows), (int* cols, int ncols)};
+%apply (int* IN_ARRAY1, int DIM1) { (int* init, int ninit), (int* spins, int nspins)};
+%apply (double* IN_ARRAY1, int DIM1) { (double* betas, int nbetas), (double* dbetas, int ndbetas)};
+%apply (int* IN_ARRAY1, int DIM1) { (int* handles, int nhandles)};
+%apply (int* IN_ARRAY1, int DIM1) { (int* record, int nrecord)};
+%apply (double* INPLACE_ARRAY1, int DIM1) { (double* energies, int nenergies)};
+%apply (double* INPLACE_ARRAY1, int DIM1) { (double* spins, int nspins), (double* scalars, int nscalars)};
+%apply (signed char* INPLACE_ARRAY1, int DIM1) { (signed char* spins, int nspins)};
+%apply (signed char** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2) { (signed char** view, int* nreps, int* nspins)};
+%apply (double* ARGOUT_ARRAY1, int DIM1) { (double* sched, int nsched)};
+%apply (int* ARGOUT_ARRAY1, int DIM1) { (int* slots, int nslots)};
+%apply (double* IN_ARRAY1, int DIM1) { (double* vals, int nvals)};
 
+%ignore set_wait_hooks;
 %include "sa.h"
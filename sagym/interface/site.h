@@ -32,52 +32,17 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #ifndef __SITE_H__
 #define __SITE_H__
 
-
-/**
- * Each site stores information about neighboring sites.
- */
-struct neighbor_type {
-
-  size_t id;
-
-  double coupler;
-
-  neighbor_type(size_t id, const double coupler) :
-    id(id), coupler(coupler) {
-  }
-
-};
+#include <cmath>
+#include <cstddef>
 
 
 /**
- * Stores data associated with a single spin.
+ * A single term of the Hamiltonian, coupling spin s0 to spin s1 with
+ * weight val.  A link with s0 == s1 is a linear (bias) term.
+ *
+ * Per-site data lives in the lattice's compressed rows (see Lattice) and
+ * in the dense spin and local field arrays of each replica (see Algorithm).
  */
-struct site_type{
-
-  int spin;
-
-  /**
-  * Coefficients of the linear terms
-  */
-  double local_field_bias;
-
-  /**
-  * Local field
-  */
-  double de;
-
-  /**
-  * Count of neighboring sites.
-  */
-  size_t nneighbs;
-
-  /**
-  * List of neighboring sites
-  */
-  std::vector<neighbor_type> neighbors;
-
-};
-
 struct Link {
 
   size_t s0;
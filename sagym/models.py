@@ -36,22 +36,80 @@ def one():
     """Return one as a float"""
     return 1.0
 
+def toroidal_nn_indices(L):
+    """Return the (rows, cols) of the L x L toroidal nearest-neighbour model
+       in latfile order: first the bias of every site, then each site's
+       coupling to its up and left neighbours (see ising_get_neighbours).
+    """
+    N = L**2
+    sites = np.arange(N, dtype=np.intc)
+    up = (sites - L) % N
+    left = (sites // L) * L + (sites - 1) % L
+
+    rows = np.empty(3*N, dtype=np.intc)
+    cols = np.empty(3*N, dtype=np.intc)
+    rows[:N] = cols[:N] = sites
+    rows[N:] = np.repeat(sites, 2)
+    cols[N::2] = up
+    cols[N+1::2] = left
+    return rows, cols
+
+def toroidal_couplings(L, kind='gaussian', rng=None):
+    """Draw the 2*L**2 couplings J of the L x L toroidal nearest-neighbour
+       model in one vectorized call, in the order of toroidal_nn_indices.
+         'gaussian'  : J ~ N(0, 1),
+         'truncated' : J ~ N(0, 0.5**2) truncated to [-1, 1],
+         'pm'        : J = +1 or -1 with equal probability,
+         'ferro'     : J = 1.
+       rng is a numpy RandomState; np.random by default.
+    """
+    if rng is None:
+        rng = np.random
+    n = 2 * L**2
+    if kind == 'gaussian':
+        return rng.normal(loc=0, scale=1.0, size=n)
+    elif kind == 'truncated':
+        J = rng.normal(loc=0, scale=0.5, size=n)
+        outside = np.abs(J) > 1
+        while outside.any():
+            J[outside] = rng.normal(loc=0, scale=0.5, size=outside.sum())
+            outside = np.abs(J) > 1
+        return J
+    elif kind == 'pm':
+        return np.where(rng.random_sample(n) < 0.5, -1.0, 1.0)
+    elif kind == 'ferro':
+        return np.ones(n)
+    raise ValueError(f"unknown kind of couplings '{kind}'")
+
+def toroidal_links(L, kind='gaussian', rng=None):
+    """Return a random L x L toroidal nearest-neighbour instance (see
+       toroidal_couplings) as arrays (rows, cols, couplings), in latfile
+       order.  Note -J is stored, not J.
+    """
+    rows, cols = toroidal_nn_indices(L)
+    vals = np.zeros(3 * L**2, dtype=np.float64)
+    vals[L**2:] = -toroidal_couplings(L, kind=kind, rng=rng)
+    return rows, cols, vals
+
+def ferro_ising_links(L=4, J=one):
+    """Return the links of the L x L toroidal nearest-neighbour model as
+       arrays (rows, cols, couplings), in latfile order: first the bias of
+       every site, then each site's coupling to its up and left neighbours.
+       Note -J is stored, not J.
+    """
+    rows, cols = toroidal_nn_indices(L)
+    vals = np.zeros(3 * L**2, dtype=np.float64)
+    vals[L**2:] = [-J() for _ in range(2 * L**2)]
+    return rows, cols, vals
+
 def make_ferro_ising(latfile_path, L=4, J=one):
+    rows, cols, vals = ferro_ising_links(L=L, J=J)
     with open(latfile_path, 'w') as F:
 
         F.write(f"{L**2}\n")
-        
-        for i in range(L**2):
-            """For each site, write explicitly the bias."""
-            F.write(f"{i} {i} 0.0 \n")
-
-        for i in range(L**2):
-            """For each site, calculate the neighbours"""
-            ns = ising_get_neighbours(i, L)
-            for neighbour in [ns[0], ns[1]]:
-                """For each neighbour, write an entry in the latfile. Note -J is written, not J"""
 
-                F.write(f"{i} {neighbour} {-J()} \n")
+        for i, j, Hij in zip(rows, cols, vals):
+            F.write(f"{i} {j} {Hij} \n")
 
 
 def normal():
@@ -76,3 +134,17 @@ def make_rndj_nn_sg(latfile, L, seed=None):
     
 def make_rndj_notrunc_nn_sg(latfile, L, seed=None):
     make_nn_ising(latfile=latfile, J=normal, L=L, seed=seed)
+
+def rndj_nn_sg_links(L, seed=None):
+    """As make_rndj_nn_sg, but return the (rows, cols, couplings) arrays
+       instead of writing a latfile."""
+    if seed is not None:
+        np.random.seed(seed)
+    return toroidal_links(L, kind='truncated')
+
+def rndj_notrunc_nn_sg_links(L, seed=None):
+    """As make_rndj_notrunc_nn_sg, but return the (rows, cols, couplings)
+       arrays instead of writing a latfile."""
+    if seed is not None:
+        np.random.seed(seed)
+    return toroidal_links(L, kind='gaussian')
@@ -0,0 +1,160 @@
+"""-----------------------------------------------------------------------------
+
+Copyright (C) 2019-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+-----------------------------------------------------------------------------
+
+Packed Hamiltonian datasets: every instance of a latticefiles dataset
+directory in a single file that is memory-mapped when read.
+
+The file is an 8 byte magic string, the length of a JSON header as a
+little-endian uint64, the header, and then raw little-endian arrays, each
+aligned to 64 bytes.  The header holds the instance names (the original
+directory names) and the dtype, shape and offset of every array:
+    link_offsets (int64, [instances + 1]): the links of instance i are
+        entries link_offsets[i] up to link_offsets[i+1] of
+    rows, cols (int32), couplings (float64): the latfile links
+    gs_energy (float64, [instances]): the ground state energies, NaN
+        where a gs_energy file was missing
+
+To convert a dataset directory:
+    python -m sagym.packed latticefiles/toroidal2d/RND_J/16x16/validation validation.pack
+"""
+
+import argparse
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b'SAGYMPK1'
+ALIGNMENT = 64
+
+
+def pack_directory(directory, path):
+    """
+    Pack every instance subdirectory of a dataset directory (each with a
+    latfile and, usually, a gs_energy file) into a single file.
+
+    Args:
+        directory (str): The dataset directory
+        path (str): The packed file to write
+
+        Returns:
+            num_instances (int): The number of instances packed
+    """
+    from sagym.helper import read_latfile
+
+    names = sorted(os.listdir(directory))
+    links = []
+    gs_energy = np.full(len(names), np.nan)
+    for i, name in enumerate(names):
+        links.append(read_latfile(os.path.join(directory, name, 'latfile')))
+        try:
+            with open(os.path.join(directory, name, 'gs_energy')) as F:
+                gs_energy[i] = float(F.read())
+        except (OSError, ValueError):
+            pass
+
+    lengths = [len(rows) for rows, _, _ in links]
+    arrays = {
+        'link_offsets': np.concatenate(([0], np.cumsum(lengths))).astype('<i8'),
+        'rows': np.concatenate([l[0] for l in links]).astype('<i4'),
+        'cols': np.concatenate([l[1] for l in links]).astype('<i4'),
+        'couplings': np.concatenate([l[2] for l in links]).astype('<f8'),
+        'gs_energy': gs_energy.astype('<f8'),
+    }
+    write_packed(path, names, arrays)
+    return len(names)
+
+
+def write_packed(path, names, arrays):
+    """Write named arrays, and the instance names, in the packed layout"""
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        layout[key] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += array.nbytes
+    header = json.dumps({'names': list(names), 'arrays': layout}).encode()
+
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path, 'wb') as F:
+        F.write(MAGIC)
+        F.write(struct.pack('<Q', len(header)))
+        F.write(header)
+        for key, array in arrays.items():
+            F.seek(start + layout[key]['offset'])
+            F.write(np.ascontiguousarray(array).tobytes())
+
+
+class PackedHamiltonians(object):
+    """A packed dataset, memory-mapped.  Only the header is read when it is
+       opened; instances are read from the page cache as they are used.
+
+       Attributes:
+           names (list of str): The instance names
+           gs_energy (1d array, float): The ground state energies
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as F:
+            if F.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a packed Hamiltonian dataset")
+            length, = struct.unpack('<Q', F.read(8))
+            header = json.loads(F.read(length).decode())
+        start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+        self.names = header['names']
+        self._arrays = {}
+        for key, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                self._arrays[key] = np.empty(shape, dtype=spec['dtype'])
+            else:
+                self._arrays[key] = np.memmap(path, dtype=spec['dtype'], mode='r',
+                                              offset=start + spec['offset'], shape=shape)
+        self.gs_energy = self._arrays['gs_energy']
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        """Return the position of the instance with the given name"""
+        return self._index[name]
+
+    def __getitem__(self, i):
+        """Return the links of instance i as (rows, cols, couplings),
+           suitable for SA.load_hamiltonian"""
+        offsets = self._arrays['link_offsets']
+        a, b = offsets[i], offsets[i + 1]
+        return (self._arrays['rows'][a:b],
+                self._arrays['cols'][a:b],
+                self._arrays['couplings'][a:b])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a dataset directory of latfiles into a single memory-mappable file")
+    parser.add_argument("directory", help="Dataset directory, with one subdirectory per instance")
+    parser.add_argument("output", help="Packed file to write")
+    args = parser.parse_args()
+    n = pack_directory(args.directory, args.output)
+    print(f"Packed {n} instances into {args.output}")
+
+
+if __name__ == '__main__':
+    main()
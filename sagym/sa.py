@@ -17,23 +17,149 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 
 -----------------------------------------------------------------------------"""
 
+import weakref
 from sagym.interface import sa_interface as sa
 import numpy as np
 
 class SA(object):
     """This is a very thin wrapper class over the SA C++ interface,
        yltsom to document the interface and do thin error checking.
+
+       Each SA instance owns its own annealer engine in the backend, so
+       several independent Hamiltonians may be annealed side by side in
+       a single process.  The engine is released when the SA object is
+       garbage collected.
+
+       The reps may also be split into num_groups groups of equal size,
+       each with a Hamiltonian of its own (see load_hamiltonian), so that
+       a single run() anneals num_groups instances at once.  Group g holds
+       reps g*num_reps/num_groups up to (g+1)*num_reps/num_groups; the
+       ensemble averages (energy, magnetization, beta) are then taken over
+       all groups.
+
+       Args:
+           num_reps (int): The number of reps annealed side by side
+           num_threads (int): The number of OpenMP threads sharing the
+               reps.  If None, the OpenMP default (OMP_NUM_THREADS) is used.
+           num_groups (int): The number of replica groups, which must
+               divide num_reps
     """
-    def reset(self, beta=None):
+    def __init__(self, num_reps=64, num_threads=None, num_groups=1):
+        if num_reps < 1:
+            raise ValueError("num_reps must be positive")
+        if num_threads is not None and num_threads < 1:
+            raise ValueError("num_threads must be positive")
+        if num_groups < 1 or num_reps % num_groups:
+            raise ValueError("num_groups must be positive and divide num_reps")
+        self._handle = sa.create(num_reps, num_threads or 0, num_groups)
+        # Bound now, so that the engine is still released at interpreter
+        # exit, after the module globals are gone; it runs at most once
+        self._finalizer = weakref.finalize(self, sa.destroy, self._handle)
+
+    def load_latfile(self, latfile, group=None):
+        """
+        Load the Hamiltonian defined in a latfile.  The lattices must be
+        reset before the next call to run().
+
+        Args:
+            latfile (str): Path to the latfile
+            group (int): The replica group to load it into, or None for
+                all of them
+        """
+        sa.load_latfile(self._handle, latfile, _group_arg(group))
+
+    def load_hamiltonian(self, rows, cols, couplings, biases=None, group=None):
         """
-        Reinitialize the SA lattice(s).  Note that the latfile Hamiltonian
-          definition is read upon import, not upon reset, so the Hamiltonian
-          will not be refreshed if it is changed on disk.
+        Load a Hamiltonian from arrays, without touching the filesystem.
+        Entry k couples spin rows[k] to spin cols[k] with weight
+        couplings[k]; entries with rows[k]==cols[k] are linear terms, as
+        in a latfile.  The lattices must be reset before the next call
+        to run().
+
+        Args:
+            rows (1d array, int): First spin of each coupling
+            cols (1d array, int): Second spin of each coupling
+            couplings (1d array, float): Coupling weights
+            biases (1d array, float): Optional linear term for every spin,
+                i.e. biases[i] is the weight of the link (i, i)
+            group (int): The replica group to load it into, or None for
+                all of them.  Every group must have the same number of
+                spins.
+        """
+        rows = np.asarray(rows, dtype=np.intc)
+        cols = np.asarray(cols, dtype=np.intc)
+        couplings = np.asarray(couplings, dtype=np.float64)
+        if biases is not None:
+            sites = np.arange(len(biases), dtype=np.intc)
+            rows = np.concatenate((sites, rows))
+            cols = np.concatenate((sites, cols))
+            couplings = np.concatenate(
+                (np.asarray(biases, dtype=np.float64), couplings))
+        sa.load_hamiltonian(self._handle, rows, cols, couplings,
+                            _group_arg(group))
+
+    def has_hamiltonian(self):
+        """
+        Return whether a Hamiltonian has been loaded into every replica
+        group of this engine
+        """
+        return bool(sa.has_hamiltonian(self._handle))
+
+    def get_torus_size(self):
+        """
+        Return L if the Hamiltonian of every group is an L x L torus of
+        nearest-neighbour couplings with the spins in row-major order (as
+        in latticefiles/toroidal2d, or models.toroidal_links), else 0.
+        Tori are detected when loaded and swept by a specialized kernel
+        that computes the neighbours by index arithmetic.
+        """
+        return sa.get_torus_size(self._handle)
+
+    def set_stencil(self, enabled=True):
+        """
+        Choose whether tori are swept by the specialized torus kernel (the
+        default) or by the generic one, e.g. for benchmarking.  A seeded
+        run gives identical results with either only if the rejection-free
+        kernel is off (see set_rejection_free); otherwise both sample the
+        same distribution, but along different trajectories.
+        Args:
+            enabled (bool): Whether to use the torus kernel
+        """
+        sa.set_stencil(self._handle, int(enabled))
+
+    def reset(self, beta=None, init='uniform', shared_init=False, seed=None):
+        """
+        Reinitialize the SA lattice(s).  The current Hamiltonian is kept
+          across resets; if none has been loaded yet, ./latfile is read.
 
         Args:
             beta (float): Reset the (reciprocal) temperature to this value.
+            init (str or array): The initial spin configuration.  Either
+                the name of a backend generator,
+                  'uniform'   : each spin up or down with probability 1/2,
+                  'bernoulli' : a uniformly distributed number of up spins,
+                                placed at random,
+                  'wsc'       : the first half of the spins down, the
+                                rest up,
+                or an array of spins of size [spins] (shared by every rep)
+                or [reps, spins].  Array entries other than +1/-1 are
+                drawn at random.
+            shared_init (bool): Draw a single configuration from the
+                generator and start every rep from it.
+            seed (int): A non-negative integer below 2**63.  Each rep then
+                draws from its own stream determined by (seed, rep), so the
+                run is reproducible and independent of the number of
+                threads.  If None, the reps are seeded from the clock.
         """
-        sa.reset(beta)
+        if seed is None:
+            seed = -1
+        elif not 0 <= seed < 2**63:
+            raise ValueError("seed must be a non-negative integer below 2**63")
+        if isinstance(init, str):
+            sa.reset(self._handle, beta, init, int(shared_init), seed)
+        else:
+            init = np.ascontiguousarray(init, dtype=np.intc).reshape(-1)
+            sa.reset_from_array(self._handle, beta, init, seed)
 
     def set_current_beta(self, beta=None):
         """
@@ -44,10 +170,10 @@ class SA(object):
             beta (float): the desired reciprocal temperature, i.e 1/(k_B*T),
                           with k_B=1
         """
-        sa.set_current_beta(beta)
+        sa.set_current_beta(self._handle, beta)
 
 
-    def run(self, N_sweeps, dbeta=0.0):
+    def run(self, N_sweeps, dbeta=0.0, resample=False):
         """
         Run some annealing sweeps.
         Args:
@@ -55,8 +181,268 @@ class SA(object):
             dbeta (float): The amount that beta should be changed over
             the course of N_sweeps sweeps.  beta will be changed by
             dbeta/N_sweeps before *every* sweep.
+            resample (bool): If set, the reps are first resampled for the
+            step of dbeta, as in population annealing (see resample).
+        """
+        if resample:
+            sa.resample(self._handle, dbeta)
+        sa.run(self._handle, N_sweeps, dbeta)
+
+    def run_sequence(self, N_sweeps, dbetas):
+        """
+        Equivalent to calling run(N_sweeps, dbeta) for every dbeta in
+        dbetas in turn, in a single backend call.
+        Args:
+            N_sweeps (int): The number of annealing sweeps per entry
+            dbetas (1d array, float): The change in beta of every run
+        """
+        dbetas = np.ascontiguousarray(dbetas, dtype=np.float64)
+        sa.run_sequence(self._handle, dbetas, N_sweeps)
+
+    def run_schedule(self, betas, sweeps_per_beta=1, record=None, resample=False):
+        """
+        Anneal through a whole schedule in a single backend call.  For
+        every entry of betas, beta is set to that value and sweeps_per_beta
+        sweeps are performed.
+        Args:
+            betas (1d array, float): The schedule of reciprocal temperatures
+                (see get_schedule for linear and exponential ones)
+            sweeps_per_beta (int): The number of sweeps at each beta
+            record (1d array, int): Optional indices into betas after which
+                the energies of all reps are recorded
+            resample (bool): If set, run population annealing: before the
+                sweeps of every entry, the reps are resampled for the step
+                from the previous beta (see resample)
+
+            Returns:
+                E (2d array, float): If record is given, the energies of
+                    size [len(record), reps]
+        """
+        betas = np.ascontiguousarray(betas, dtype=np.float64)
+        if record is None:
+            checkpoints = np.empty(0, dtype=np.intc)
+        else:
+            checkpoints = np.ascontiguousarray(record, dtype=np.intc)
+        energies = np.empty(len(checkpoints) * self.get_num_reps())
+        sa.run_schedule(self._handle, betas, sweeps_per_beta, checkpoints,
+                        energies, int(resample))
+        if record is not None:
+            return np.reshape(energies, (len(checkpoints), -1))
+
+    def resample(self, dbeta):
+        """
+        Population annealing resampling for a step of dbeta in beta.  In
+        every group, rep r is weighted by exp(-dbeta*E_r), and the group is
+        replaced by a resample of itself of the same size, with about
+        group size * normalized weight copies of rep r.  beta itself is
+        not changed.
+        Args:
+            dbeta (float): The step in beta the weights are taken for
+        """
+        sa.resample(self._handle, dbeta)
+
+    def get_population_weights(self):
+        """
+        Return the normalized weights of every rep at the last resample,
+        which sum to one over every group.
+
+            Returns:
+                weights (1d array, float): Array of size [reps]
+        """
+        return sa.get_population_weights(self._handle, self.get_num_reps())
+
+    def get_population_stats(self):
+        """
+        Return population annealing diagnostics, one entry per group:
+            log_z_ratio: the free energy estimate log(Z(beta)/Z(beta0)),
+                summed over the resampling steps since reset
+            ess: the effective population size of the last resample, as a
+                fraction of the group size, 1/(size*sum(weights**2))
+            families: the number of distinct families, i.e. reps at the
+                last reset that still have descendants
+            rho: the mean square family size, size*sum((n_f/size)**2);
+                large values mean a few families dominate the group
+
+            Returns:
+                stats (dict): Arrays of size [groups] by name
+        """
+        num_groups = self.get_num_groups()
+        weights = np.reshape(self.get_population_weights(), (num_groups, -1))
+        families = np.reshape(sa.get_families(self._handle, self.get_num_reps()), (num_groups, -1))
+        size = weights.shape[1]
+        sizes = [np.unique(f, return_counts=True)[1] / size for f in families]
+        return {
+            'log_z_ratio': sa.get_log_partition_ratio(self._handle, num_groups),
+            'ess': 1.0 / (size * np.sum(weights**2, axis=1)),
+            'families': np.array([len(s) for s in sizes]),
+            'rho': np.array([size * np.sum(s**2) for s in sizes]),
+        }
+
+    def set_rejection_free(self, threshold=0.05):
+        """
+        Switch reps to a rejection-free (n-fold way) sweep while the
+        acceptance ratio of their last sweep is below threshold.  It
+        samples the same process as the Metropolis sweep, at a cost in
+        proportion to the accepted flips rather than to the proposals, so
+        it pays off late in the anneal.  On by default, with a threshold
+        of 0.05; 0 turns it off.  Kept across reset().
+        Args:
+            threshold (float): The acceptance ratio below which a rep
+                switches kernels
+        """
+        sa.set_rejection_free(self._handle, threshold)
+
+    def get_rejection_free_sweeps(self):
+        """
+        Return the number of sweeps, summed over reps, made by the
+        rejection-free kernel since reset
+        """
+        return sa.get_rejection_free_sweeps(self._handle)
+
+    def set_cluster_moves(self, wolff=0.0, houdayer=0.0):
+        """
+        Interleave cluster moves with the Metropolis sweeps.  The rates are
+        average numbers of moves per sweep (e.g. 0.1 is one move every 10
+        sweeps), are kept across reset(), and 0 turns a kind of move off.
+        Args:
+            wolff (float): Wolff moves per rep, made after its sweeps.  A
+                cluster is grown over satisfied couplings and flipped,
+                subject to the fields.  Meant for ferromagnetic couplings.
+            houdayer (float): Houdayer moves per pair of reps at the same
+                beta: a cluster of sites where the two differ is flipped in
+                both, which keeps their total energy.  Meant for spin
+                glasses.  Reps 2m and 2m+1 are paired, or, with a ladder
+                (see set_ladder), the reps at the same beta of chains 2c
+                and 2c+1.  Not applied by run_batch.
+        """
+        sa.set_cluster_moves(self._handle, wolff, houdayer)
+
+    def get_cluster_stats(self):
+        """
+        Return the cluster move statistics since reset.
+
+            Returns:
+                stats (dict): 'wolff_moves' (accepted Wolff moves),
+                    'wolff_size' (their mean size), 'houdayer_moves' and
+                    'houdayer_size'
+        """
+        stats = sa.get_cluster_stats(self._handle, 4)
+        return dict(zip(('wolff_moves', 'wolff_size', 'houdayer_moves', 'houdayer_size'), stats))
+
+    def set_ladder(self, betas):
+        """
+        Set up parallel tempering (replica exchange).  The reps of every
+        group are split into chains of len(betas) consecutive reps, and
+        the reps of each chain are given the betas of the ladder.  Must be
+        called after reset(), which clears the ladder.  If a ladder of the
+        same size is set again, every rep keeps its position in it.
+        Args:
+            betas (1d array, float): The ladder of reciprocal temperatures
+                (see geometric_ladder).  Its size must divide the number
+                of reps per group.
+        """
+        betas = np.ascontiguousarray(betas, dtype=np.float64)
+        sa.set_ladder(self._handle, betas)
+
+    def get_ladder(self):
+        """
+        Return the ladder of reciprocal temperatures, or an empty array
+        if none is set
+        """
+        return sa.get_ladder(self._handle, sa.get_ladder_size(self._handle))
+
+    def run_tempering(self, N_sweeps, exchange_interval=1):
+        """
+        Run N_sweeps sweeps at the fixed betas of the ladder, attempting
+        exchanges between neighbouring betas of every chain after every
+        exchange_interval sweeps.
+        Args:
+            N_sweeps (int): The number of sweeps to perform
+            exchange_interval (int): The number of sweeps between rounds
+                of exchange attempts
+        """
+        sa.run_tempering(self._handle, N_sweeps, exchange_interval)
+
+    def get_exchange_acceptance(self):
+        """
+        Return the fraction of accepted exchanges between every pair of
+        neighbouring betas of the ladder since it was set.
+
+            Returns:
+                acceptance (1d array, float): Array of size [ladder size - 1]
         """
-        sa.run(N_sweeps, dbeta)
+        size = sa.get_ladder_size(self._handle)
+        if size == 0:
+            raise RuntimeError("no ladder has been set")
+        return sa.get_exchange_acceptance(self._handle, size - 1)
+
+    def get_ladder_replicas(self):
+        """
+        Return the rep at every beta of every chain.
+
+            Returns:
+                reps (2d array, int): Array of size [chains, ladder size],
+                    where entry [c, k] is the rep of chain c at beta k
+        """
+        size = sa.get_ladder_size(self._handle)
+        if size == 0:
+            raise RuntimeError("no ladder has been set")
+        reps = sa.get_ladder_replicas(self._handle, self.get_num_reps())
+        return np.reshape(reps, (-1, size))
+
+    def adapt_ladder(self, min_acceptance=0.01):
+        """
+        Move the inner betas of the ladder so as to even out the exchange
+        acceptance between neighbouring betas, keeping both ends fixed,
+        and set the new ladder.  The log of the acceptance of a pair
+        scales roughly with the square of its beta gap, so each gap is
+        divided by the square root of -log(acceptance) and the gaps are
+        then rescaled to the same total.  Call it between runs of
+        run_tempering, which gather the acceptance.
+        Args:
+            min_acceptance (float): Floor on the acceptance of a pair, so
+                that pairs that never exchanged still give a finite gap
+
+            Returns:
+                betas (1d array, float): The new ladder
+        """
+        ladder = self.get_ladder()
+        acceptance = np.clip(self.get_exchange_acceptance(), min_acceptance, 1 - 1e-6)
+        gaps = np.diff(ladder) / np.sqrt(-np.log(acceptance))
+        gaps *= (ladder[-1] - ladder[0]) / gaps.sum()
+        betas = np.concatenate(([ladder[0]], ladder[0] + np.cumsum(gaps)))
+        betas[-1] = ladder[-1]
+        self.set_ladder(betas)
+        return betas
+
+    def run_async(self, N_sweeps, dbeta=0.0):
+        """
+        As run(), but return immediately while the sweeps proceed in the
+        background, with the GIL released.  Any other call on this object
+        first waits for the sweeps to finish, also with the GIL released.
+        Args:
+            N_sweeps (int): The number of annealing sweeps to perform.
+            dbeta (float): The amount that beta should be changed over
+            the course of N_sweeps sweeps.
+
+            Returns:
+                run (AsyncRun): A handle to wait on the sweeps
+        """
+        sa.run_async(self._handle, N_sweeps, dbeta)
+        return AsyncRun(self)
+
+    def wait(self):
+        """
+        Block (with the GIL released) until the sweeps started by
+        run_async() have finished.  Returns at once if nothing is running.
+        """
+        sa.wait_run(self._handle)
+
+    def is_running(self):
+        """
+        Return whether sweeps started by run_async() are still in progress
+        """
+        return bool(sa.is_running(self._handle))
 
 
     def get_num_reps(self):
@@ -66,7 +452,16 @@ class SA(object):
         Returns:
             reps (int): The number of reps
         """
-        return sa.get_num_reps()
+        return sa.get_num_reps(self._handle)
+
+    def get_num_threads(self):
+        """
+        Return the number of OpenMP threads sharing the reps
+
+        Returns:
+            threads (int): The number of threads
+        """
+        return sa.get_num_threads(self._handle)
 
     def get_num_spins(self):
         """
@@ -75,7 +470,7 @@ class SA(object):
         Returns:
             spins (int): The number of spins (i.e. lattice size)
         """
-        return sa.get_num_spins()
+        return sa.get_num_spins(self._handle)
 
     def set_lattice(self, lattice):
         """
@@ -90,8 +485,8 @@ class SA(object):
         assert lattice.shape == (reps,spins), \
             "The provided spin values are not of shape [reps, spins]"
 
-        sa.set_lattice(lattice.flatten(order='C')) #, lattice.size)
-#        sa.set_lattice(lattice, reps*spins)
+        sa.set_lattice(self._handle,
+                       np.ascontiguousarray(lattice, dtype=np.intc).reshape(-1))
 
 
     def get_lattice(self):
@@ -104,7 +499,7 @@ class SA(object):
         """
         reps = self.get_num_reps()
         spins = self.get_num_spins()
-        lattices = sa.get_lattice(reps*spins)
+        lattices = sa.get_lattice(self._handle, reps*spins)
         lattices = np.reshape(lattices, (reps, spins))
         return lattices
 
@@ -116,7 +511,7 @@ class SA(object):
                 E (float): The average energy over the ensemble of lattices
         """
 
-        return sa.get_average_energy()
+        return sa.get_average_energy(self._handle)
 
 
     def get_all_energies(self):
@@ -127,9 +522,28 @@ class SA(object):
                 E (1d array, float): Array of energies of size [reps]
 
         """
-        energies = sa.get_all_energies(self.get_num_reps())
+        energies = sa.get_all_energies(self._handle, self.get_num_reps())
         return energies
 
+    def get_group_energies(self):
+        """
+        Return the individual energies for each rep, by replica group
+
+            Returns:
+                E (2d array, float): Array of energies of size
+                    [groups, reps/groups]
+        """
+        return np.reshape(self.get_all_energies(), (self.get_num_groups(), -1))
+
+    def get_num_groups(self):
+        """
+        Return the number of replica groups
+
+        Returns:
+            groups (int): The number of groups
+        """
+        return sa.get_num_groups(self._handle)
+
     def get_acceptance_ratio(self):
         """
         Return the acceptance ratio of the last call to run(),
@@ -138,7 +552,7 @@ class SA(object):
             Returns:
                 r (float): acceptance ratio
         """
-        ratio = sa.get_acceptance_ratio()
+        ratio = sa.get_acceptance_ratio(self._handle)
         return ratio
 
 
@@ -156,7 +570,7 @@ class SA(object):
                     above.
         """
 
-        return sa.get_average_absolute_magnetization()
+        return sa.get_average_absolute_magnetization(self._handle)
 
     def get_stddev_average_absolute_magnetization(self):
         """
@@ -171,7 +585,7 @@ class SA(object):
                     above.
         """
 
-        return sa.get_stddev_mean_absolute_magnetization()
+        return sa.get_stddev_mean_absolute_magnetization(self._handle)
 
 
     def get_current_beta(self):
@@ -183,4 +597,189 @@ class SA(object):
             beta (float): the current value of beta
 
         """
-        return sa.get_current_beta()
+        return sa.get_current_beta(self._handle)
+
+    def snapshot(self, out=None, spins=True):
+        """
+        Read the spins, the energies of all reps and the scalar readouts in
+        a single backend call.  The values are those of get_lattice(),
+        get_all_energies(), get_current_beta(),
+        get_average_absolute_magnetization(), get_average_energy() and
+        get_acceptance_ratio(); as with the latter, the acceptance counters
+        are reset.
+
+        Args:
+            out (Snapshot): Optional buffers from an earlier call, or from
+                new_snapshot(), to fill instead of allocating new ones.
+                Their spins may be float64 or int8, or a view onto the
+                engine (see new_snapshot).
+            spins (bool): Whether to read the spins as well; if not, the
+                spins of out (or a view's buffer) are left as they were
+
+            Returns:
+                snapshot (Snapshot): out, or a newly allocated Snapshot
+        """
+        if out is None:
+            out = self.new_snapshot()
+        if not spins:
+            sa.snapshot(self._handle, _NO_SPINS, out.energies, out.scalars)
+        elif out.view:
+            sa.snapshot_view(self._handle, out.spins.size, out.energies,
+                             out.scalars)
+        elif out.spins.dtype == np.int8:
+            sa.snapshot_int8(self._handle, out.spins.reshape(-1),
+                             out.energies, out.scalars)
+        else:
+            sa.snapshot(self._handle, out.spins.reshape(-1), out.energies,
+                        out.scalars)
+        return out
+
+    def new_snapshot(self, dtype=np.float64, view=False):
+        """
+        Return a Snapshot sized for this engine, to be filled by snapshot()
+
+        Args:
+            dtype (numpy dtype): np.float64 or np.int8, the type of the spins
+            view (bool): Instead of a buffer of its own, give the Snapshot a
+                read-only int8 view onto a buffer owned by the engine (see
+                spin_view), which snapshot() then refreshes without a copy
+                through Python.
+        """
+        if view:
+            return Snapshot(self.get_num_reps(), self.get_num_spins(),
+                            spins=self.spin_view())
+        return Snapshot(self.get_num_reps(), self.get_num_spins(), dtype=dtype)
+
+    def spin_view(self):
+        """
+        Return a read-only int8 array of size [reps, spins] that looks
+        directly at the engine's snapshot buffer.  Its contents only change
+        when snapshot() is called with a Snapshot from
+        new_snapshot(view=True); copy it to keep an observation beyond the
+        next snapshot.  The view (and any array derived from it) keeps this
+        SA object alive, and while it lives, reset() refuses to grow the
+        engine to more spins.
+        """
+        raw = sa.get_spin_view(self._handle)
+        view = np.asarray(_SpinViewOwner(self, raw))
+        view.flags.writeable = False
+        return view
+
+def get_schedule(kind, nsweeps, beta0, beta1):
+    """
+    Return an annealing schedule from the backend.
+    Args:
+        kind (str): 'lin' for a linear schedule, 'exp' for an exponential
+            one.  Any other value is read as a file of betas, which must
+            then hold exactly nsweeps entries.
+        nsweeps (int): The number of entries in the schedule
+        beta0 (float): The reciprocal temperature at the start
+        beta1 (float): The reciprocal temperature at the end
+
+        Returns:
+            betas (1d array, float): Array of size [nsweeps]
+    """
+    return sa.get_schedule(kind, beta0, beta1, nsweeps)
+
+
+def geometric_ladder(beta_min, beta_max, num_betas):
+    """
+    Return a parallel tempering ladder of num_betas reciprocal
+    temperatures from beta_min to beta_max in geometric progression.
+    """
+    return np.geomspace(beta_min, beta_max, num_betas)
+
+
+def _group_arg(group):
+    if group is None:
+        return -1
+    if group < 0:
+        raise ValueError("group must be non-negative")
+    return group
+
+
+def run_batch(annealers, N_sweeps, dbetas):
+    """
+    Run N_sweeps sweeps on several engines in a single backend call, as if
+    annealers[b].run(N_sweeps, dbetas[b]) were called for every b, with
+    the replicas of all engines shared out between one set of threads.
+    Args:
+        annealers (list of SA): Distinct engines
+        N_sweeps (int): The number of annealing sweeps to perform
+        dbetas (1d array, float): The change in beta of every engine
+    """
+    handles = np.array([a._handle for a in annealers], dtype=np.intc)
+    dbetas = np.ascontiguousarray(dbetas, dtype=np.float64)
+    sa.run_batch(handles, dbetas, N_sweeps)
+
+
+_NO_SPINS = np.empty(0)
+
+
+class Snapshot(object):
+    """Preallocated buffers for SA.snapshot()
+
+       Attributes:
+           spins (2d array, float or int8): Spins of size [reps, spins]
+           energies (1d array, float): Energy of every rep
+           scalars (1d array, float): beta, average absolute magnetization,
+               average energy and acceptance ratio, also available under
+               those names
+           view (bool): Whether spins is a read-only view onto the engine
+    """
+    def __init__(self, num_reps, num_spins, dtype=np.float64, spins=None):
+        if spins is None:
+            if np.dtype(dtype) not in (np.float64, np.int8):
+                raise ValueError("spins must be float64 or int8")
+            self.spins = np.empty((num_reps, num_spins), dtype=dtype)
+            self.view = False
+        else:
+            self.spins = spins
+            self.view = True
+        self.energies = np.empty(num_reps)
+        self.scalars = np.empty(4)
+
+    @property
+    def beta(self):
+        return self.scalars[0]
+
+    @property
+    def magnetization(self):
+        return self.scalars[1]
+
+    @property
+    def energy(self):
+        return self.scalars[2]
+
+    @property
+    def acceptance(self):
+        return self.scalars[3]
+
+
+class _SpinViewOwner(object):
+    """The base of a spin view: it exposes the engine's buffer to numpy,
+       holds a reference to the SA object that owns the buffer, and tells
+       the engine when the view is gone."""
+    def __init__(self, annealer, raw):
+        self.annealer = annealer
+        self.__array_interface__ = {
+            'data': (raw.__array_interface__['data'][0], True),
+            'shape': raw.shape,
+            'typestr': raw.dtype.str,
+            'version': 3,
+        }
+        weakref.finalize(self, sa.release_spin_view, annealer._handle)
+
+
+class AsyncRun(object):
+    """Handle to the sweeps started by SA.run_async()"""
+    def __init__(self, annealer):
+        self._annealer = annealer
+
+    def done(self):
+        """Return whether the sweeps have finished"""
+        return not self._annealer.is_running()
+
+    def wait(self):
+        """Block until the sweeps have finished"""
+        self._annealer.wait()
@@ -20,8 +20,8 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 from abc import abstractmethod
 from collections import deque
 from gym import spaces
+from gym.utils import seeding
 import time
-import h5py
 import logging
 import numpy as np
 import threading
@@ -37,8 +37,162 @@ warnings.filterwarnings("ignore")
 logging.basicConfig(level=logging.INFO)
 
 class RenderObjects():
-    def __init__(self):
+    """Per-episode telemetry, kept in preallocated arrays that are reused
+       from episode to episode.
+
+       The level sets what is recorded at every step:
+         'off'     : nothing,
+         'scalars' : temperature (Tdat), magnetization (Mdat), energy
+                     (Edat), action (Adat) and acceptance ratio (arat),
+         'full'    : the scalars and the observed lattices (states).
+       The arrays hold `capacity` steps; should an episode run longer, they
+       act as ring buffers and keep its last `capacity` steps.
+    """
+    LEVELS = ('off', 'scalars', 'full')
+    SCALARS = ('Tdat', 'Mdat', 'Edat', 'Adat', 'arat')
+
+    def __init__(self, level='off'):
         self.first_render = True
+        self.steps = 0
+        self._capacity = 0
+        self._scalars = None
+        self._states = None
+        self.set_level(level)
+
+    def set_level(self, level):
+        if level not in self.LEVELS:
+            raise ValueError(f"telemetry level must be one of {self.LEVELS}")
+        self.level = level
+        if level != 'full':
+            self._states = None
+
+    def clear(self, capacity):
+        """Start a new episode of at most capacity steps"""
+        self.steps = 0
+        if capacity != self._capacity:
+            self._capacity = capacity
+            self._scalars = None
+            self._states = None
+
+    def record(self, state, T, M, E, A, arat):
+        if self.level == 'off':
+            return
+        if self._scalars is None:
+            self._scalars = np.empty((len(self.SCALARS), self._capacity))
+        i = self.steps % self._capacity
+        self._scalars[:, i] = (T, M, E, A, arat)
+        if self.level == 'full':
+            if self._states is None or self._states.shape[1:] != state.shape or self._states.dtype != state.dtype:
+                self._states = np.empty((self._capacity,) + state.shape, dtype=state.dtype)
+            self._states[i] = state
+        self.steps += 1
+
+    def _ordered(self, data):
+        # Oldest step first, also once the ring buffer has wrapped around
+        if self.level == 'off':
+            return None
+        if data is None:
+            return np.empty(0)
+        if self.steps <= self._capacity:
+            return data[:self.steps]
+        i = self.steps % self._capacity
+        return np.concatenate((data[i:], data[:i]))
+
+    @property
+    def states(self):
+        return self._ordered(self._states)
+
+    def __getattr__(self, name):
+        if name in RenderObjects.SCALARS:
+            data = self.__dict__.get('_scalars')
+            if data is not None:
+                data = data[RenderObjects.SCALARS.index(name)]
+            return self._ordered(data)
+        raise AttributeError(name)
+
+class StepProfile():
+    """Per-step timing and counters of an environment (see
+       SAGym.set_profiling).  A step is split into
+         prepare : Python work before the sweeps (action handling, and
+                   the replay of destructive observation, whose sweeps are
+                   counted as sweeps),
+         sweep   : the backend sweeps,
+         readout : the state readout after the sweeps,
+         finish  : Python work after the readout (reward, done).
+       With SAVecEnv the sweep phase of every environment is the time of
+       the shared batch call, timed by SAVecEnv (see batched); the other
+       environments' prepare and finish work in between is left out, so
+       the phases of a step need not add up to its wall time.
+       updates_per_sec counts attempted spin updates (sweeps
+       times spins), whichever sweep kernel ran them, not accepted flips;
+       acceptance gives the fraction that were flipped.
+    """
+    PHASES = ('prepare', 'sweep', 'readout', 'finish')
+
+    def __init__(self):
+        self.steps = 0
+        self.sweeps = 0
+        self.updates = 0
+        self.acceptance = 0.0
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.starttime = time.time()
+        self._marks = []
+        self._replay = (0.0, 0)
+        self._batch = None
+
+    def begin(self):
+        self._marks = [time.perf_counter()]
+        self._replay = (0.0, 0)
+        self._batch = None
+
+    def mark(self):
+        self._marks.append(time.perf_counter())
+
+    def replayed(self, seconds, sweeps):
+        self._replay = (seconds, sweeps)
+
+    def batched(self, seconds):
+        """The sweeps were run by SAVecEnv, alongside other environments'
+        work, and took seconds; that is the step's sweep time."""
+        self._batch = seconds
+
+    def end(self, sweeps, spins, acceptance):
+        """Close the step and return its profile.  sweeps is the number of
+        sweeps of the step, spins the number of spin updates per sweep."""
+        self.mark()
+        replay_time, replay_sweeps = self._replay
+        times = dict(zip(self.PHASES, np.diff(self._marks)))
+        if self._batch is not None:
+            times['sweep'] = self._batch
+        times['prepare'] -= replay_time
+        times['sweep'] += replay_time
+        sweeps += replay_sweeps
+
+        self.steps += 1
+        self.sweeps += sweeps
+        self.updates += sweeps * spins
+        self.acceptance += acceptance
+        for phase in self.PHASES:
+            self.totals[phase] += times[phase]
+
+        profile = {phase + '_time': times[phase] for phase in self.PHASES}
+        profile['sweeps_per_sec'] = sweeps / times['sweep'] if times['sweep'] > 0 else np.nan
+        profile['updates_per_sec'] = sweeps * spins / times['sweep'] if times['sweep'] > 0 else np.nan
+        profile['acceptance'] = acceptance
+        return profile
+
+    def summary(self):
+        total = sum(self.totals.values())
+        sweep = self.totals['sweep']
+        summary = {'steps': self.steps, 'sweeps': self.sweeps, 'walltime': time.time() - self.starttime}
+        for phase in self.PHASES:
+            summary[phase + '_time'] = self.totals[phase]
+            summary[phase + '_fraction'] = self.totals[phase] / total if total > 0 else np.nan
+        summary['sweeps_per_sec'] = self.sweeps / sweep if sweep > 0 else np.nan
+        summary['updates_per_sec'] = self.updates / sweep if sweep > 0 else np.nan
+        summary['acceptance'] = self.acceptance / self.steps if self.steps else np.nan
+        return summary
+
 
 class SAGym(gym.Env):
     def __init__(self):
@@ -48,21 +202,22 @@ class SAGym(gym.Env):
         self.set_num_sweeps(100)
         self.action_scaling = 1.0
         self.DESTRUCTIVE_OBSERVATION = False
+        self.latinit = 'uniform'
+        self._np_random = None
 
         self._dump_dataframes = False
         self._episode_counter = 0
         self._last_state = None
+        self._snapshot = None
+        self._state_shape = None
+        self.observation_dtype = np.float64
+        self._observation_view = False
         self._step_counter = 0
+        self._profile = None
         self._RO = RenderObjects()
         self._RO.reward_range = [0, 0]
         self._RO.step_range = [0, 0]
         self._RO.episode_reward = []
-        self._RO.steps = 0
-        self._RO.states = []
-        self._RO.Tdat = []
-        self._RO.Mdat = []
-        self._RO.Edat = []
-        self._RO.Adat = []
         self._make_movie = False
         self._RO.success_prob = []
         self.r_deque = deque(maxlen=100)
@@ -102,32 +257,47 @@ class SAGym(gym.Env):
             super(...).step()
         """
         self._step_counter += 1
-        self._RO.steps += 1
-        self._RO.states.append(self._last_state[0])
-        self._RO.Tdat.append(1./self._last_state[1])
-        self._RO.Mdat.append(self._last_state[2])
-        self._RO.Edat.append(self._last_state[3])
-        self._RO.Adat.append(np.asscalar(action))
-        self._RO.arat.append(self._sa.get_acceptance_ratio())
+        self._RO.record(self._last_state[0],
+                        1./self._last_state[1],
+                        self._last_state[2],
+                        self._last_state[3],
+                        np.asscalar(action),
+                        self._snapshot.acceptance)
+
+    def set_observation_mode(self, dtype=np.float64, view=False):
+        """
+        Choose how the spins are observed: as float64 or int8 copies, or
+        (view=True) as a read-only int8 view onto a buffer owned by the
+        annealer.  A view is overwritten by the next step, so a consumer
+        that keeps observations must copy them.
+        """
+        if view:
+            dtype = np.int8
+        self.observation_dtype = np.dtype(dtype).type
+        self._observation_view = view
+        self._snapshot = None
 
     def _get_state(self, action=None):
-        beta = self._sa.get_current_beta()
-        if np.isnan(beta) or beta==0.0:
-            beta = self._beta_upon_reset
-
+        # One backend call reads the spins, energies and scalar readouts;
+        # the snapshot buffers are reused from step to step, and across
+        # episodes while the number of spins (read once per reset) is
+        # unchanged.
+        if self._snapshot is None or self._snapshot.spins.shape != self._state_shape:
+            self._snapshot = self._sa.new_snapshot(dtype=self.observation_dtype, view=self._observation_view)
+        snap = self._sa.snapshot(out=self._snapshot)
 
         _return_2d = True
 
         if _return_2d:
-            s = self.lattice2d
+            s = snap.spins if snap.view else snap.spins.copy()
         else:
-            s = self.lattice1d
+            s = snap.spins.flatten()
 #        s = self.rectifylattice(s)
         self._last_state = [
                 s,
-                self._sa.get_current_beta(),
-                self._sa.get_average_absolute_magnetization(),
-                self._sa.get_average_energy()]
+                snap.beta,
+                snap.magnetization,
+                snap.energy]
         
         return s
 
@@ -137,25 +307,65 @@ class SAGym(gym.Env):
 
     def toggle_datadump_on(self):
         self._dump_dataframes = True
+        self.set_telemetry('full')
 
     def toggle_datadump_off(self):
         self._dump_dataframes = False
+        self.set_telemetry('off')
 
+    def set_profiling(self, on=True):
+        """
+        Turn per-step profiling on (with fresh counters) or off.  When on,
+        every step's info holds its profile under 'profile' (see
+        StepProfile) and get_profile() summarizes all steps since.
+        """
+        self._profile = StepProfile() if on else None
+
+    def get_profile(self):
+        """
+        Return the cumulative profile since profiling was turned on, or
+        None if it is off
+        """
+        if self._profile is None:
+            return None
+        return self._profile.summary()
+
+    def set_telemetry(self, level):
+        """
+        Choose what is recorded in self._RO at every step: 'off',
+        'scalars' or 'full' (see RenderObjects).  Dumping dataframes
+        needs 'full'.
+        """
+        self._RO.set_level(level)
+
+
+    def seed(self, seed=None):
+        """
+        Make the episodes reproducible: every later reset draws the backend
+        seed of its episode from a generator seeded here.  With seed=None
+        the replicas are seeded from the clock again.
+        """
+        if seed is None:
+            self._np_random = None
+            return [None]
+        self._np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def _next_seed(self):
+        if self._np_random is None:
+            return None
+        return int(self._np_random.randint(2**63 - 1))
 
     def reset(self):
         self._RO.first_render=True
-        self._RO.steps = 0
-        self._RO.Tdat = []
-        self._RO.Mdat = []
-        self._RO.Edat = []
-        self._RO.Adat = []
-        self._RO.states = []
-        self._RO.arat = []
+        self._RO.clear(self.max_ep_length or 1024)
         self._step_counter = 0
         self._last_hard_reset_beta=self._beta_upon_reset
-        self._sa.reset(beta=self._last_hard_reset_beta)
-        self._energies_before_action = -self._sa.get_all_energies() / self.SPIN_N
-        return self._get_state()
+        self._sa.reset(beta=self._last_hard_reset_beta, init=self.latinit, shared_init=True, seed=self._next_seed())
+        self._state_shape = (self._sa.get_num_reps(), self._sa.get_num_spins())
+        state = self._get_state()
+        self._energies_before_action = -self._snapshot.energies / self.SPIN_N
+        return state
 
     def set_num_sweeps(self, N):
         """
@@ -168,6 +378,9 @@ class SAGym(gym.Env):
         Set the reciprocal temperature
         """
         self._sa.set_current_beta(beta=beta)
+        # Steps read the current beta from the last snapshot
+        if self._snapshot is not None:
+            self._snapshot.scalars[0] = self._sa.get_current_beta()
 
     
     def render_close(self):
@@ -182,7 +395,7 @@ class Placeholder(object):
         pass
     def print_to_screen(self):
         pass
-    def write(self):
+    def write(self, *args, **kwargs):
         logging.info("This is a placeholder. Nothing to write")
 
 
@@ -196,11 +409,11 @@ class SAGymContinuousRandomJ(SAGym):
     def __init__(self):
         super().__init__()
 
-        from sagym.helper import generate_latinit
-        self.generate_latinit = generate_latinit
+        self.latinit = 'bernoulli'
 
         self.HSR = Placeholder()
         self._first_reset = True
+        self._episode_store = None
         self.HG = None
         self.experiment_tag = None
 
@@ -209,7 +422,36 @@ class SAGymContinuousRandomJ(SAGym):
         self.SPIN_N = int(os.environ['LATTICE_L'])**2
 
         self.action_space = spaces.Box(low=-1, high=1, shape=(1,))
-        self.observation_space = spaces.Box(low=-1, high=1, shape=(64, self.SPIN_N, 1))
+        self._sa = None
+        self._pending_run = None
+        self.num_threads = None
+        self.set_num_reps(int(os.environ.get('SAGYM_NUM_REPS', 64)))
+
+    def set_num_reps(self, num_reps, num_threads=None):
+        """
+        Set the number of reps (the first dimension of the observations)
+        and, optionally, the number of OpenMP threads annealing them.
+        Defaults to $SAGYM_NUM_REPS, or 64.  Takes effect at the next reset.
+        """
+        self.num_reps = num_reps
+        if num_threads is not None:
+            self.num_threads = num_threads
+        self._make_observation_space()
+        if self._sa is not None:
+            self._make_annealer()
+
+    def set_observation_mode(self, dtype=np.float64, view=False):
+        super().set_observation_mode(dtype=dtype, view=view)
+        self._make_observation_space()
+
+    def _make_observation_space(self):
+        self.observation_space = spaces.Box(low=-1, high=1, shape=(self.num_reps, self.SPIN_N, 1), dtype=self.observation_dtype)
+
+    def _make_annealer(self):
+        from sagym.sa import SA
+        self._sa = SA(num_reps=self.num_reps, num_threads=self.num_threads)
+        self._loaded_hamiltonian = None
+        self._snapshot = None
 
     def initialization_checks(self):
         if self.HG is None:
@@ -230,35 +472,41 @@ class SAGymContinuousRandomJ(SAGym):
         self.results_dir = os.path.join('./results', self.experiment_tag)
         os.makedirs(self.results_dir, exist_ok=True)
 
-    def init_HamiltonianGetter(self, phase='TRAIN', directory=None): 
+    def init_HamiltonianGetter(self, phase='TRAIN', directory=None, prefetch=0): 
+        """prefetch (TRAIN only) is the number of random instances drawn
+        ahead by a background thread; see RandomHamiltonianGetter."""
+        if self.HG is not None and hasattr(self.HG, 'close'):
+            self.HG.close()
         if phase=='TRAIN': 
             L = int(os.environ['LATTICE_L']) 
             from sagym.helper import RandomHamiltonianGetter 
-            self.HG = RandomHamiltonianGetter(L) 
-            from sagym.helper import generate_latinit 
-            self.generate_latinit = generate_latinit 
+            self.HG = RandomHamiltonianGetter(L, prefetch=prefetch) 
+            self.latinit = 'bernoulli'
         elif phase=='WSC': 
             from sagym.helper import FileHamiltonianGetter 
             assert directory is not None, "Directory cannot be None" 
             self.HG = FileHamiltonianGetter(directory=directory, disable_random=True, static=0)
-            from sagym.helper import generate_WSC_latinit 
-            self.generate_latinit = generate_WSC_latinit 
+            self.latinit = 'wsc'
         elif phase=='VALUE_ANALYSIS' or phase=='ISING':
-            from sagym.helper import generate_latinit
-            self.generate_latinit = generate_latinit
+            self.latinit = 'bernoulli'
             from sagym.helper import FileHamiltonianGetter 
             assert directory is not None, "Directory cannot be None" 
             self.HG = FileHamiltonianGetter(directory=directory, disable_random=True, static=0) 
         elif phase=='TEST': 
-            from sagym.helper import generate_latinit
-            self.generate_latinit = generate_latinit
+            self.latinit = 'bernoulli'
             from sagym.helper import FileHamiltonianGetter 
             assert directory is not None, "Directory cannot be None" 
             self.HG = FileHamiltonianGetter(directory=directory, disable_random=False, static=None) 
         self.HG.get()
 
-        from sagym.sa import SA
-        self._sa = SA()
+        self._make_annealer()
+
+    def _load_hamiltonian(self):
+        """Hand the Hamiltonian Getter's current instance to the annealer,
+        unless it is the instance that is already loaded."""
+        if self.HG.hamiltonian is not self._loaded_hamiltonian:
+            self._sa.load_hamiltonian(*self.HG.hamiltonian)
+            self._loaded_hamiltonian = self.HG.hamiltonian
 
 
     def init_HamiltonianSuccessRecorder(self, num_hamiltonians, num_trials):
@@ -276,7 +524,17 @@ class SAGymContinuousRandomJ(SAGym):
         self.HSR.write(os.path.join(self.results_dir, 'HamiltonianSuccess.dat'))
 
     def close_env(self):
-        self.hsr_write()
+        # The Hamiltonian prefetch and the episode store are shut down even
+        # if writing the recorder fails, so that the episode file is
+        # complete and no background thread is left running
+        try:
+            self.hsr_write()
+        finally:
+            if self.HG is not None and hasattr(self.HG, 'close'):
+                self.HG.close()
+            if self._episode_store is not None:
+                store, self._episode_store = self._episode_store, None
+                store.close()
 
     def set_destructive_observation_on(self):
         self.DESTRUCTIVE_OBSERVATION = True
@@ -313,30 +571,31 @@ class SAGymContinuousRandomJ(SAGym):
         
         
         if not(self._first_reset) and self._dump_dataframes:
-            os.makedirs(os.path.join(self.results_dir, "dataframes/"),exist_ok=True)
-            with h5py.File(os.path.join(self.results_dir,
-                                        "dataframes/",
-                                        f"episode_{str(self._episode_counter).zfill(6)}.h5"), 'w') as F:
-                F.create_dataset("states", data=np.array(self._RO.states))
-                F.create_dataset("Tdat", data=np.array(self._RO.Tdat))
-                F.create_dataset("Adat", data=np.array(self._RO.Adat))
-                F.create_dataset("arat", data=np.array(self._RO.arat))
-                F.create_dataset("Mdat", data=np.array(self._RO.Mdat))
-                F.create_dataset("Edat", data=np.array(self._RO.Edat))
-                success = evaluate_success(-self.get_all_energies() / self.SPIN_N, self.success_reward)
-                F.create_dataset("success", data=success)
-                F.create_dataset("terminal_energies", data=self.get_all_energies() / self.SPIN_N)
-                F.create_dataset("ground_state_energy", data=-self.success_reward)
+            if self._episode_store is None:
+                from sagym.episode_store import EpisodeWriter
+                self._episode_store = EpisodeWriter(os.path.join(self.results_dir, "episodes.h5"))
+            energies = self.get_all_energies()
+            fields = {
+                "success": evaluate_success(-energies / self.SPIN_N, self.success_reward),
+                "terminal_energies": energies / self.SPIN_N,
+                "ground_state_energy": -self.success_reward}
+            # Only the columns recorded at the current telemetry level
+            if self._RO.level != 'off':
+                for name in RenderObjects.SCALARS:
+                    fields[name] = getattr(self._RO, name)
+            if self._RO.level == 'full':
+                fields["states"] = self._RO.states
+            self._episode_store.write(self._episode_counter, fields)
 
         self._first_reset = False
         self._episode_counter +=1
 
-        #Call HG.get, which copies a random latfile from a library of latfiles, and returns the ground state energy
-        #Generate a random starting configuration
+        #Call HG.get, which picks a Hamiltonian from a library of latfiles (or draws a random one), and returns the ground state energy
+        #The random starting configuration is drawn by the backend upon reset
 
-        self.generate_latinit(lines=self.SPIN_N)
         self.sum_of_rewards = 0
         self.HG.get()
+        self._load_hamiltonian()
         s = super().reset()
 
         self._actions_taken_since_reset = []
@@ -352,47 +611,88 @@ class SAGymContinuousRandomJ(SAGym):
         return np.expand_dims(s, axis=-1)
 
     def step(self, action):  #RANDOM J
+        self.step_async(action)
+        return self.step_wait()
+
+    def step_async(self, action):
+        """Apply the action and start its annealing sweeps in the background.
+        The caller may do other work (e.g. policy inference for another
+        environment) before collecting the result with step_wait()."""
+        dbeta = self._prepare_step(action)
+        self._pending_run = self._sa.run_async(self._Nsweeps, float(dbeta))
+
+    def step_wait(self):
+        """Wait for the sweeps started by step_async() and return the usual
+        (observation, reward, done, info) tuple."""
+        self._pending_run.wait()
+        self._pending_run = None
+        return self._finish_step()
+
+    def _prepare_step(self, action):
+        """Everything step() does before the sweeps of the action.  Returns
+        the change in beta to anneal by."""
+        profile = self._profile
+        if profile is not None:
+            profile.begin()
+
         action = action/self.action_scaling
         dbeta = np.asscalar(action)
 
+        # The beta of the last readout; nothing has swept since
+        beta = self._snapshot.beta
         penalize_action = False
-        if self._sa.get_current_beta() + dbeta <= 0.0001: 
+        if beta + dbeta <= 0.0001: 
             penalize_action = True
-        if self._sa.get_current_beta() + dbeta > 20.0:
+        if beta + dbeta > 20.0:
             penalize_action = True
             dbeta = 0.0 
 
         super().step(action)
 
         if self.DESTRUCTIVE_OBSERVATION:
-            # Destroy the system by:
-            #   (a) creating a new latinit, and,
-            #   (b) resetting the spins.
-            self.generate_latinit(lines=self.SPIN_N)
-            self._sa.reset(beta=self._last_hard_reset_beta)
+            # Destroy the system by resetting the spins to a freshly
+            # drawn initial configuration.
+            self._sa.reset(beta=self._last_hard_reset_beta, init=self.latinit, shared_init=True, seed=self._next_seed())
             # Then evolve the "new" system by the old policy by
             # repeating all actions that were taking up to this time
-            for i,db in enumerate(self._actions_taken_since_reset):
-                self._sa.run(self._Nsweeps, float(db))
+            if profile is not None:
+                t = time.perf_counter()
+            self._sa.run_sequence(self._Nsweeps, self._actions_taken_since_reset)
+            if profile is not None:
+                profile.replayed(time.perf_counter() - t, self._Nsweeps * len(self._actions_taken_since_reset))
 
         self._actions_taken_since_reset.append(dbeta)
-        self._sa.run(self._Nsweeps, float(dbeta))
+        self._penalize_action = penalize_action
+        if profile is not None:
+            profile.mark()
+        return dbeta
+
+    def _finish_step(self):
+        """Everything step() does after the sweeps of the action."""
+        profile = self._profile
+        if profile is not None:
+            profile.mark()
+
+        state = self._get_state()
 
-        state = self._get_state(action=action)
+        if profile is not None:
+            profile.mark()
 
-        Es = self._sa.get_all_energies()/self.SPIN_N
+        Es = self._snapshot.energies/self.SPIN_N
 
         if self._step_counter >= self.max_ep_length:
             reward = -np.min(Es) #min energy at final step of episode
             done = True
         else:
-            if penalize_action:
+            if self._penalize_action:
                 reward = -0.1
             else:
                 reward=0
             done = False
 
         info = {}
+        if profile is not None:
+            info['profile'] = profile.end(self._Nsweeps, self._snapshot.energies.size * self.SPIN_N, self._snapshot.acceptance)
 
         if done:
             self.r_deque.append(reward)
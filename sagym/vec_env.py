@@ -0,0 +1,130 @@
+"""-----------------------------------------------------------------------------
+
+Copyright (C) 2019-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+-----------------------------------------------------------------------------"""
+
+import time
+import numpy as np
+from stable_baselines.common.vec_env import VecEnv
+
+from sagym.sa import run_batch
+
+
+class SAVecEnv(VecEnv):
+    """A stable_baselines VecEnv over several SAContinuousRandomJ
+       environments, each with its own Hamiltonian, replicas and beta.
+
+       Where DummyVecEnv steps the environments one after the other, the
+       sweeps of all environments are run by a single backend call, with
+       the replicas of every environment shared out between one set of
+       OpenMP threads.  Environments that finish an episode are reset
+       automatically; the last observation of the episode is then returned
+       in info['terminal_observation'].
+
+       Args:
+           env_fns (list): Functions that each return a new environment.
+               Gym wrappers around the environments are bypassed while
+               stepping, since the environments are driven through the
+               unwrapped SAGymContinuousRandomJ objects.
+    """
+    def __init__(self, env_fns):
+        self.envs = [fn().unwrapped for fn in env_fns]
+        env = self.envs[0]
+        VecEnv.__init__(self, len(self.envs), env.observation_space, env.action_space)
+
+        self.buf_obs = None
+        self.buf_rews = np.zeros((self.num_envs,), dtype=np.float32)
+        self.buf_dones = np.zeros((self.num_envs,), dtype=np.bool)
+        self.buf_infos = [{} for _ in range(self.num_envs)]
+        self.actions = None
+
+    def _obs_from(self, index, obs):
+        # The observation space may change (set_num_reps,
+        # set_observation_mode) after construction, so the batch buffer
+        # follows the first observation.
+        if self.buf_obs is None or self.buf_obs.shape[1:] != obs.shape or self.buf_obs.dtype != obs.dtype:
+            self.observation_space = self.envs[0].observation_space
+            self.buf_obs = np.zeros((self.num_envs,) + obs.shape, dtype=obs.dtype)
+        self.buf_obs[index] = obs
+
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            self._obs_from(i, env.reset())
+        return np.copy(self.buf_obs)
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        dbetas = np.array([env._prepare_step(action) for env, action in zip(self.envs, self.actions)], dtype=np.float64)
+
+        nsweeps = set(env._Nsweeps for env in self.envs)
+        if len(nsweeps) == 1:
+            t = time.perf_counter()
+            run_batch([env._sa for env in self.envs], nsweeps.pop(), dbetas)
+            seconds = time.perf_counter() - t
+            for env in self.envs:
+                if env._profile is not None:
+                    env._profile.batched(seconds)
+        else:
+            for env, dbeta in zip(self.envs, dbetas):
+                t = time.perf_counter()
+                env._sa.run(env._Nsweeps, float(dbeta))
+                if env._profile is not None:
+                    env._profile.batched(time.perf_counter() - t)
+
+        for i, env in enumerate(self.envs):
+            obs, self.buf_rews[i], self.buf_dones[i], self.buf_infos[i] = env._finish_step()
+            if self.buf_dones[i]:
+                # Copied, since in view mode the reset overwrites it
+                self.buf_infos[i]['terminal_observation'] = obs.copy()
+                obs = env.reset()
+            self._obs_from(i, obs)
+
+        return (np.copy(self.buf_obs), np.copy(self.buf_rews), np.copy(self.buf_dones),
+                [info.copy() for info in self.buf_infos])
+
+    def seed(self, seed=None):
+        if seed is None:
+            return [env.seed(None)[0] for env in self.envs]
+        return [env.seed(seed + i)[0] for i, env in enumerate(self.envs)]
+
+    def close(self):
+        # close_env stops each env's Hamiltonian prefetch and flushes its
+        # episode store; gym's close() does neither
+        for env in self.envs:
+            env.close_env()
+
+    def get_images(self):
+        return [env.render(mode='rgb_array') for env in self.envs]
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(env, attr_name) for env in self._envs_at(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        for env in self._envs_at(indices):
+            setattr(env, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(env, method_name)(*method_args, **method_kwargs) for env in self._envs_at(indices)]
+
+    def _envs_at(self, indices):
+        if indices is None:
+            indices = range(self.num_envs)
+        elif isinstance(indices, int):
+            indices = [indices]
+        return [self.envs[i] for i in indices]
@@ -14,7 +14,7 @@ except AttributeError:
 
 
 extra_compile_args = ["-Wall","-ansi","-pedantic","-std=c++11","-O3","-funroll-loops","-pipe"]
-extra_compile_args += ["-fopenmp"]
+extra_compile_args += ["-fopenmp", "-pthread"]
 
 sa_module = Extension('_sa_interface',
                       language='c++',
@@ -23,7 +23,7 @@ sa_module = Extension('_sa_interface',
                       sources=['sagym/interface/sa_interface_wrap.cxx', 
                         'sagym/interface/sa.cc'],
                       extra_compile_args=extra_compile_args,
-                      extra_link_args=['-lgomp'],
+                      extra_link_args=['-lgomp', '-pthread'],
                      )
 
 
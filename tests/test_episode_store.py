@@ -0,0 +1,66 @@
+"""-----------------------------------------------------------------------------
+
+Copyright (C) 2019-2020 1QBit
+Contact info: Pooya Ronagh <pooya@1qbit.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+
+-----------------------------------------------------------------------------"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sagym.episode_store import EpisodeWriter, EpisodeReader
+
+
+class TestEpisodeStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'episodes.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_telemetry_level_changes_between_episodes(self):
+        # A 'scalars' episode, then a 'full' one, then 'scalars' again
+        rng = np.random.RandomState(0)
+        written = []
+        for episode, full in enumerate((False, True, False)):
+            fields = {name: rng.normal(size=5) for name in ('Tdat', 'Edat')}
+            fields['success'] = np.array([episode % 2 == 0] * 4)
+            if full:
+                fields['states'] = rng.choice([-1, 1], size=(5, 4, 3)).astype(np.int8)
+            written.append(fields)
+
+        store = EpisodeWriter(self.path)
+        for episode, fields in enumerate(written):
+            store.write(episode, fields)
+        store.close()
+
+        with EpisodeReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+            self.assertEqual(reader.index.tolist(), [[0, 5], [5, 5], [10, 5]])
+            for episode, fields in enumerate(written):
+                read = reader[episode]
+                self.assertEqual(read['episode'], episode)
+                self.assertEqual(sorted(read), sorted(list(fields) + ['episode']))
+                for name, value in fields.items():
+                    np.testing.assert_array_equal(read[name], value)
+            np.testing.assert_array_equal(reader[-1]['Tdat'], written[-1]['Tdat'])
+
+
+if __name__ == '__main__':
+    unittest.main()